@@ -0,0 +1,381 @@
+"""Measures the performance of get_bibtex.
+
+Usage:
+  python benchmark.py suite [--citations N ...] [--existing FRACTION] [--json] [--baseline FILE]
+  python benchmark.py parse [--json] [--repeat N] [--chunk BYTES] [page.html ...]
+  python benchmark.py record KEY ...
+
+The suite generates a synthetic LaTeX tree and BibTeX files with the given numbers of
+citations of all the bibliographies, replays the provider responses from the fixtures in
+benchmark_fixtures/ through a local HTTP server, and times every phase of a run. The
+fixtures are templates in which {id} is replaced by the identifier of the key; responses
+recorded with `record` are replayed instead of them for their keys."""
+import argparse
+import contextlib
+import hashlib
+import http.server
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+import xml.etree.ElementTree as ET
+
+import get_bibtex
+
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_fixtures')
+
+# name, citation key prefix and template of each provider
+PROVIDERS = [('arxiv', 'Arxiv:', 'arxiv.html'), ('base', 'BASE:', 'base.bib'),
+             ('cogprints', 'Cogprints:', 'cogprints.bib'), ('dblp', 'DBLP:', 'dblp.bib'),
+             ('jstor', 'JSTOR:', 'jstor.bib'), ('microsoft', 'Microsoft:', 'microsoft.bib'),
+             ('springer', 'Springer:', 'springer.bib')]
+ARXIV_API = ('arxiv-api', 'Arxiv:', 'arxiv-api.xml')
+
+SENTENCE = 'We study "self-consistent" models of well-\nknown systems and prove new bounds. '
+
+def authors_html(count):
+    """Returns the author links of an arXiv abstract page"""
+    return ', '.join(f'<a href="/a/author_{i}">Author {i}</a>' for i in range(count))
+
+def synthetic_id(name, number):
+    """Returns a made-up identifier of the provider, which is valid in its citation keys"""
+    if name == 'arxiv':
+        return f'{10 + number // 120000 % 14:02d}{1 + number // 10000 % 12:02d}.{number % 10000:05d}'
+    if name == 'dblp':
+        return f'conf/bench/Author{number}'
+    if name == 'springer':
+        return f'978-3-030-{number // 100:05d}-{number % 10}_{number % 100}'
+    return f'{name}{number}' if name in ('base', 'microsoft') else str(100000 + number)
+
+def synthetic_keys(citations):
+    """Returns the given number of distinct citation keys, spread evenly over the providers"""
+    return [PROVIDERS[i % len(PROVIDERS)][1] + synthetic_id(PROVIDERS[i % len(PROVIDERS)][0], i // len(PROVIDERS))
+            for i in range(citations)]
+
+def generate_tree(directory, citations, existing=0.5, per_file=200, seed=0):
+    """Writes a LaTeX tree citing the given number of keys, and BibTeX files that already
+    hold the given fraction of them. Returns the number of .tex files"""
+    rng = random.Random(seed)
+    keys = synthetic_keys(citations)
+    rng.shuffle(keys)
+
+    files = 0
+    for start in range(0, len(keys), per_file):
+        chunk = keys[start:start + per_file]
+        chunk += rng.sample(keys[:start + len(chunk)], min(len(chunk) // 10, start + len(chunk)))
+        part = os.path.join(directory, 'chapters', f'part{files // 50:03d}')
+        os.makedirs(part, exist_ok=True)
+        with open(os.path.join(part, f'section{files:05d}.tex'), 'w', encoding='utf-8') as tex_file:
+            tex_file.write(f'\\section{{Section {files}}}\n')
+            for group in range(0, len(chunk), 3):
+                tex_file.write(f'Some text citing earlier work~\\cite{{{", ".join(chunk[group:group + 3])}}}.\n')
+                if group % 30 == 0:
+                    tex_file.write('% a comment that does not cite anything\n\n')
+        files += 1
+
+    write_existing_entries(directory, keys[:int(len(keys) * existing)])
+    return files
+
+def write_existing_entries(directory, keys):
+    """Writes a BibTeX file for every provider holding entries of its keys"""
+    for name, prefix, _ in PROVIDERS:
+        with open(os.path.join(directory, f'{name}.bib'), 'w', encoding='utf-8') as bib_file:
+            for key in sorted(key for key in keys if key.startswith(prefix)):
+                bib_file.write(f'@misc{{{key},\ntitle={{An entry that is already there}},\nyear={{2020}}}}\n\n')
+
+class Fixtures():
+    """Responses of the providers: the recorded ones, or else the templates filled in with
+    the identifier of the key"""
+    def __init__(self, directory=FIXTURES_DIRECTORY):
+        self.directory = directory
+        self.templates = {}
+        for name, _, template in PROVIDERS + [ARXIV_API]:
+            with open(os.path.join(directory, template), encoding='utf-8') as template_file:
+                self.templates[name] = template_file.read().replace('{authors}', authors_html(3)).replace(
+                    '{abstract}', SENTENCE * 3)
+
+    def path(self, name, ident):
+        """Returns the path of the recorded response of the provider to the identifier"""
+        return os.path.join(self.directory, name, quote(ident, safe=''))
+
+    def response(self, name, ident):
+        """Returns the response of the provider to the request of the identifier"""
+        if os.path.isfile(self.path(name, ident)):
+            with open(self.path(name, ident), encoding='utf-8') as recorded_file:
+                return recorded_file.read()
+        return self.templates[name].replace('{id}', ident)
+
+    def record(self, name, ident, text):
+        """Saves the response of the provider to the identifier"""
+        os.makedirs(os.path.join(self.directory, name), exist_ok=True)
+        with open(self.path(name, ident), 'w', encoding='utf-8') as recorded_file:
+            recorded_file.write(text)
+        print(f'Recorded {name}/{ident}')
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the requests to one provider from the fixtures"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Sends the fixture of the requested identifier, or of all of them for the arXiv API"""
+        parts = urlsplit(self.path)
+        if self.server.name == 'arxiv-api':
+            ids = parse_qs(parts.query)['id_list'][0].split(',')
+            body = ('<?xml version="1.0" encoding="UTF-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n'
+                    + ''.join(self.server.fixtures.response('arxiv-api', ident) for ident in ids) + '</feed>\n')
+        else:
+            body = self.server.fixtures.response(self.server.name, unquote(parts.path[1:]))
+        data = body.encode('utf-8')
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.bytes += len(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Keeps the requests out of the output"""
+
+class ReplayServer(http.server.ThreadingHTTPServer):
+    """Local HTTP server that stands in for one provider"""
+    daemon_threads = True
+
+    def __init__(self, name, fixtures):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), ReplayHandler)
+        self.name = name
+        self.fixtures = fixtures
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+
+    def url(self):
+        """Returns the URL of the server"""
+        return f'http://127.0.0.1:{self.server_port}'
+
+def replay(fixtures):
+    """Starts a replay server for every provider and returns them by name"""
+    servers = {}
+    for name, _, _ in PROVIDERS + [ARXIV_API]:
+        servers[name] = ReplayServer(name, fixtures)
+        threading.Thread(target=servers[name].serve_forever, daemon=True).start()
+    return servers
+
+def make_session(directory, servers, arxiv_batch):
+    """Returns a session of get_bibtex for the directory that downloads from the replay
+    servers"""
+    registry = get_bibtex.ProviderRegistry(get_bibtex.default_providers())
+    for name, prefix, _ in PROVIDERS:
+        provider = registry.classify(prefix)
+        provider.key_url = lambda key, base=servers[name].url(), skip=len(prefix): f'{base}/{quote(key[skip:], safe="")}'
+        provider.bibtex_file = os.path.join(directory, f'{name}.bib')
+    registry.classify('Arxiv:').batch_size = arxiv_batch
+    get_bibtex.ArxivProvider.API_URL = servers['arxiv-api'].url() + '/query?id_list={ids}&max_results={count}'
+    client = get_bibtex.HttpClient()
+    client.limiter = get_bibtex.RateLimiter(0)
+    return get_bibtex.BibSession(get_bibtex.TexFiles(directory), registry, get_bibtex.BibDatabase(''), None, client)
+
+def run_suite(citations, args, servers):
+    """Runs get_bibtex on a synthetic tree with the number of citations and returns the
+    timings of its phases"""
+    directory = tempfile.mkdtemp(prefix='get_bibtex_benchmark_')
+    try:
+        files = generate_tree(directory, citations, args.existing, args.per_file, args.seed)
+        session = make_session(directory, servers, args.arxiv_batch)
+        for server in servers.values():
+            server.requests = server.bytes = 0
+        seconds = {}
+
+        with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            session.read_all_existing_files()
+            seconds['read_all_existing_files'] = time.perf_counter() - start
+            existing = len(list(session.database))
+
+            start = time.perf_counter()
+            session.read_latex()
+            seconds['read_latex'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            session.report_missing()
+            session.fetch_all(args.workers, args.host_workers, write=session.write_fetched)
+            seconds['fetch'] = time.perf_counter() - start
+            seconds['parse'] = sum(counters.get('parse_seconds', 0)
+                                   for counters in session.metrics.as_dict()['providers'].values())
+
+            start = time.perf_counter()
+            session.database.flush()
+            seconds['write'] = time.perf_counter() - start
+        session.close()
+
+        return {'citations': citations, 'tex_files': files, 'existing_entries': existing,
+                'requests': sum(server.requests for server in servers.values()),
+                'response_bytes': sum(server.bytes for server in servers.values()),
+                'failed_keys': len(session.keys.failed),
+                'entries_written': len(list(session.database)) - existing,
+                'seconds': seconds}
+    finally:
+        shutil.rmtree(directory)
+
+def regressions(results, baseline, tolerance, noise=0.01):
+    """Returns the phases that have become slower than in the baseline results by more than
+    the tolerance (a fraction), ignoring differences below the noise in seconds"""
+    slower = []
+    previous = {run['citations']: run['seconds'] for run in baseline['runs']}
+    for run in results['runs']:
+        for phase, seconds in run['seconds'].items():
+            before = previous.get(run['citations'], {}).get(phase)
+            if before is not None and seconds > before * (1 + tolerance) and seconds - before > noise:
+                slower.append(f"{run['citations']} citations, {phase}: {before:.3f} s -> {seconds:.3f} s")
+    return slower
+
+def suite(args):
+    """Runs the benchmark suite and prints its results"""
+    servers = replay(Fixtures(args.fixtures))
+    with open(get_bibtex.__file__, 'rb') as source_file:
+        version = hashlib.sha1(source_file.read()).hexdigest()[:12]
+    results = {'benchmark': 'suite', 'get_bibtex': version, 'python': platform.python_version(),
+               'runs': [run_suite(citations, args, servers) for citations in args.citations]}
+    for server in servers.values():
+        server.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for run in results['runs']:
+            print(f"{run['citations']} citations in {run['tex_files']} files, {run['existing_entries']} "
+                  f"existing entries: {run['requests']} requests, {run['entries_written']} entries written")
+            for phase, seconds in run['seconds'].items():
+                print(f'  {phase:<24} {seconds:9.3f} s')
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            slower = regressions(results, json.load(baseline_file), args.tolerance)
+        for line in slower:
+            print(f'Regression: {line}', file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+def synthetic_page(authors, sentences, fixtures_directory=FIXTURES_DIRECTORY):
+    """Returns an abstract page with the given numbers of authors and abstract sentences"""
+    with open(os.path.join(fixtures_directory, 'arxiv.html'), encoding='utf-8') as template_file:
+        page = template_file.read()
+    return page.replace('{id}', '2101.00001').replace('{authors}', authors_html(authors)).replace(
+        '{abstract}', SENTENCE * sentences).encode('utf-8')
+
+def parse_page(page, chunk_size):
+    """Feeds the page in chunks to the parser of the arXiv provider and returns the record"""
+    parser = get_bibtex.ArxivPageParser(get_bibtex.ArxivProvider(), ('Arxiv:2101.00001',))
+    for start in range(0, len(page), chunk_size):
+        parser.feed(page[start:start + chunk_size])
+    return parser.close()
+
+def measure(name, page, chunk_size, repeat):
+    """Returns the best time of parsing the page over the repeats"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse_page(page, chunk_size)
+        best = min(best, time.perf_counter() - start)
+    return {'page': name, 'bytes': len(page), 'seconds': best, 'mb_per_second': len(page) / best / 1e6}
+
+def parse(args):
+    """Runs the benchmark of parsing arXiv abstract pages and prints its results"""
+    if args.pages:
+        pages = []
+        for path in args.pages:
+            with open(path, 'rb') as page_file:
+                pages.append((path, page_file.read()))
+    else:
+        pages = [(f'{authors} authors, {sentences} sentences', synthetic_page(authors, sentences, args.fixtures))
+                 for authors, sentences in [(3, 10), (30, 100), (300, 1000), (3000, 10000)]]
+
+    results = [measure(name, page, args.chunk, args.repeat) for name, page in pages]
+    if args.json:
+        print(json.dumps({'benchmark': 'parse', 'runs': results}, indent=2))
+    else:
+        for result in results:
+            print(f"{result['page']}: {result['bytes']} bytes in {result['seconds'] * 1000:.2f} ms "
+                  f"({result['mb_per_second']:.1f} MB/s)")
+
+class Recording():
+    """Collects a response body"""
+    def __init__(self):
+        self.chunks = []
+
+    def feed(self, data):
+        """Receives the next chunk of the response"""
+        self.chunks.append(data)
+
+    def text(self):
+        """Returns the response as text"""
+        return b''.join(self.chunks).decode('utf-8')
+
+def record(args):
+    """Downloads the real responses to the keys and saves them as fixtures"""
+    fixtures = Fixtures(args.fixtures)
+    registry = get_bibtex.ProviderRegistry(get_bibtex.default_providers())
+    client = get_bibtex.HttpClient()
+    names = {prefix: name for name, prefix, _ in PROVIDERS}
+    for key in args.keys:
+        provider = registry.classify(key)
+        if provider is None:
+            print(f'(not recording {key}, it does not belong to any bibliography.)')
+            continue
+        ident = key[len(provider.prefix):]
+        _, _, recording = client.fetch(provider.key_url(key), None, Recording)
+        fixtures.record(names[provider.prefix], ident, recording.text())
+        if provider.name == 'arXiv':
+            api_url = provider.API_URL.format(ids=quote(ident), count=1)
+            _, _, recording = client.fetch(api_url, None, Recording)
+            for entry in ET.fromstring(recording.text()).iterfind('atom:entry', get_bibtex.AtomParser.NAMESPACES):
+                fixtures.record('arxiv-api', ident, ET.tostring(entry, encoding='unicode') + '\n')
+    client.close()
+
+def main():
+    """Parses the command line and runs the benchmark"""
+    arg_parser = argparse.ArgumentParser(description='Benchmarks get_bibtex.')
+    arg_parser.add_argument('--fixtures', default=FIXTURES_DIRECTORY, help='directory of the fixtures')
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+
+    suite_parser = commands.add_parser('suite', help='time the phases of runs on synthetic LaTeX trees')
+    suite_parser.add_argument('--citations', type=int, nargs='+', default=[10, 1000, 10000],
+                              help='numbers of citations, up to 100000 (default: 10 1000 10000)')
+    suite_parser.add_argument('--existing', type=float, default=0.5,
+                              help='fraction of the citations already in the BibTeX files (default: 0.5)')
+    suite_parser.add_argument('--per-file', type=int, default=200, help='citations per .tex file (default: 200)')
+    suite_parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic tree (default: 0)')
+    suite_parser.add_argument('--workers', type=int, default=8, help='concurrent downloads (default: 8)')
+    suite_parser.add_argument('--host-workers', type=int, default=2,
+                              help='concurrent downloads from one website (default: 2)')
+    suite_parser.add_argument('--arxiv-batch', type=int, default=50,
+                              help='arXiv records per request; 1 uses the abstract pages (default: 50)')
+    suite_parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    suite_parser.add_argument('--baseline', help='JSON results to compare with; exits with 1 on regressions')
+    suite_parser.add_argument('--tolerance', type=float, default=0.25,
+                              help='allowed slowdown against the baseline (default: 0.25)')
+    suite_parser.set_defaults(run=suite)
+
+    parse_parser = commands.add_parser('parse', help='time the parsing of arXiv abstract pages')
+    parse_parser.add_argument('pages', nargs='*', help='saved arXiv abstract pages')
+    parse_parser.add_argument('--repeat', type=int, default=5, help='repeats of each page (default: 5)')
+    parse_parser.add_argument('--chunk', type=int, default=64 * 1024, help='bytes fed at a time (default: 65536)')
+    parse_parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parse_parser.set_defaults(run=parse)
+
+    record_parser = commands.add_parser('record', help='record the real responses to citation keys')
+    record_parser.add_argument('keys', nargs='+', help='citation keys, e.g. Arxiv:2212.04173')
+    record_parser.set_defaults(run=record)
+
+    args = arg_parser.parse_args()
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
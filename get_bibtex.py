@@ -29,43 +29,80 @@ downloads the missing BibTeX records to a separate BibTeX file for each of the
 bibliographies, and automatically adds them as references or as part of a bibliography
 in LaTeX. Tested with Python 3.11. '''
 
-from pathlib import Path
+# the script stays in one file, so that it can still be used as a standalone executable
+# by copying it to somewhere in the path
+# pylint: disable=too-many-lines
+
 from html.parser import HTMLParser
-import urllib.request as req
+from email.utils import parsedate_to_datetime
+from itertools import chain
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urljoin, quote
+import http.client
 import os
 import os.path
 import re
 import argparse
-import configparser
 import calendar
+import codecs
+import collections
+import configparser
+import contextlib
+import copy
+import hashlib
+import heapq
+import json
+import mmap
+import queue
+import random
+import select
+import shutil
+import struct
+import sys
+import zlib
+import tempfile
+import threading
+import time
 
 ARXIV_ID_RE = re.compile(r'arXiv:((\d\d)(\d\d)\.\d+)')
-TEX_FILES_DIRECTORY = './'  # (sub)directory containing the .tex files
-ignore_tex_files = set()  # files within the directory that should be ignored
-
-known_keys = set([])
-unused_keys = set([])
-
-arxiv_keys = set([])
-fetched_arxiv_keys = set([])
-
-base_keys = set([])
-fetched_base_keys = set([])
-
-cogprints_keys = set([])
-fetched_cogprints_keys = set([])
-
-dblp_keys = set([])
-fetched_dblp_keys = set([])
-
-jstor_keys = set([])
-fetched_jstor_keys = set([])
-
-microsoft_keys = set([])
-fetched_microsoft_keys = set([])
-
-springer_keys = set([])
-fetched_springer_keys = set([])
+ARXIV_KEY_ID_RE = re.compile(r'(?:\d{4}\.\d{4,5}|[a-z]+(?:-[a-z]+)*(?:\.[A-Z]{2})?/\d{7})(?:v\d+)?')  # new and old style
+TEX_CITATION_RE = re.compile(rb'(?:cite|citep|citet|fullciteown|autocite|textcite)\{([^}]+)}')
+CROSSREF_RE = re.compile(rb'\bcrossref\s*=\s*[{"]\s*([^}",\s]+)', re.IGNORECASE)
+BIBTEX_ENTRY_RE = re.compile(rb'^[ \t]*@(?!(?i:string|preamble|comment)\b)[a-zA-Z]+[ \t]*\{[ \t]*([^,\s]+)[ \t]*,',
+                             re.MULTILINE)
+BIBTEX_BLOCK_RE = re.compile(rb'^[ \t]*@[a-zA-Z]+[ \t]*[{(]', re.MULTILINE)  # entries, @string, @preamble, @comment
+BIBTEX_ITEMS_RE = re.compile(r'(@[a-zA-Z]+\{[^@]*\n})', re.DOTALL)
+BIBTEX_ITEM_KEY_RE = re.compile(r'@[a-zA-Z]+\{([^,]+),\s*', re.DOTALL)
+EXCLUDE_DIRECTORIES = ('.git', '.hg', '.svn')  # directories that should not be searched
+# xml.etree (parse_atom), sqlite3 (ResponseCache.connection), urllib.request (HttpClient.proxy),
+# concurrent.futures, ctypes, cProfile, tracemalloc and importlib.metadata are only imported
+# where they are needed, as most runs do not need them and they would slow down every start
+
+CACHE_DIRECTORY = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                               'get_bibtex')
+CACHE_FILE = os.path.join(CACHE_DIRECTORY, 'responses.sqlite')
+BIB_INDEX_FILE = os.path.join(CACHE_DIRECTORY, 'bibtex.snapshot')
+TEX_INDEX_FILE = os.path.join(CACHE_DIRECTORY, 'tex_index.json')
+MMAP_THRESHOLD = 2**20  # files of at least this size are memory mapped instead of read
+PARALLEL_SCAN_FILES = 64  # files are only scanned in a process pool if there are at least this
+PARALLEL_SCAN_BYTES = 16 * 2**20  # many of them, or if they have at least this size in total
+MERGE_RUN_BYTES = 64 * 2**20  # entries of a merged BibTeX file that are sorted in memory at a time
+PROVIDER_OPTIONS = (('arXiv', 'a'), ('BASE', 'b'), ('Cogprints', 'c'), ('DBLP', 'd'), ('JSTOR', 'j'),
+                    ('Microsoft Research', 'm'), ('SpringerLink', 's'))  # option of each BibTeX file
+PROVIDER_SPECS = {  # the bibliographies besides arXiv, see TemplateProvider
+    'BASE': {'prefix': 'BASE:', 'bibtex_file': 'base.bib',
+             'url': 'https://www.base-search.net/Record/{id}/Export?style[]=BibTeX'},
+    'Cogprints': {'prefix': 'Cogprints:', 'bibtex_file': 'cogprints.bib',
+                  'url': 'https://web-archive.southampton.ac.uk/cogprints.org/cgi/export/eprint/{id}.bib.html'},
+    'DBLP': {'prefix': 'DBLP:', 'bibtex_file': 'dblp.bib', 'writer': 'entries',
+             'url': 'https://dblp.org/rec/{id}.bib'},
+    'JSTOR': {'prefix': 'JSTOR:', 'bibtex_file': 'jstor.bib',
+              'url': 'https://www.jstor.org/citation/text/{id}'},
+    'Microsoft Research': {'prefix': 'Microsoft:', 'bibtex_file': 'microsoft.bib',
+                           'url': 'https://www.microsoft.com/en-us/research/publication/{id}/bibtex/'},
+    'SpringerLink': {'prefix': 'Springer:', 'bibtex_file': 'springer.bib',
+                     'url': 'https://citation-needed.springer.com/v2/references/10.1007/{id}'}}
+PROVIDER_ENTRY_POINTS = 'get_bibtex.providers'  # entry point group of the provider plugins
 
 class BibItem():
     """Represents BibTeX items"""
@@ -88,99 +125,99 @@ class BibItem():
             key = 'Arxiv:' + url.rsplit('/', 1)[-1]
         return key
 
-    def dump(self):
-        """Dumps BibTeX items and keys to the dictionary and returns it"""
-        dic = f'@{self.bibtype}{{{self.gen_key()}'
-        for key, val in self.field.items():
-            if val not in ['', None]:
-                dic += f',\n{key}={{{val}}}'
-        dic += '}\n'
-        return dic
+    def dump(self, key=None):
+        """Dumps BibTeX items and keys to the dictionary and returns it. The entry is written
+        under the given key, such as the cited key, or else under the generated one"""
+        dic = [f'@{self.bibtype}{{{key or self.gen_key()}']
+        dic.extend(f',\n{key}={{{val}}}' for key, val in self.field.items() if val not in ['', None])
+        dic.append('}\n')
+        return ''.join(dic)
 
 class AbstParser():
-    """Abstract basis for parsing texts"""
+    """Abstract basis for parsing texts: turns double quotes into LaTeX quotes and line
+    breaks into spaces, and drops the hyphens that are followed by a space or line break.
+    The text may be fed in chunks; it is scanned in runs of ordinary characters"""
+    TOKEN_RE = re.compile(r'[^"\n-]+|["\n-]')
+
     def __init__(self):
-        self.parse = self.parse_main
-        self.text = ''
+        self.parts = []
+        self.in_quote = False
+        self.hyphen = False
+
+    @property
+    def text(self):
+        """Returns the parsed text"""
+        return ''.join(self.parts)
 
     def feed(self, text):
         """Receives data from the texts"""
-        i = 0
-        while i < len(text):
-            (self.parse, i) = self.parse(text, i)
-
-    def parse_main(self, text, i):
-        """Parses the main texts"""
-        char = text[i]
-        if char == '"':
-            self.text += '``'
-            return (self.parse_quote, i+1)
-        if char == '-':
-            return (self.parse_hyphen, i+1)
-        else:
-            if char == '\n':
-                self.text += ' '
-            else:
-                self.text += char
-            return (self.parse_main, i+1)
-
-    def parse_quote(self, text, i):
-        """Parses the quote symbols in the texts"""
-        char = text[i]
-        if char == '"':
-            self.text += '\'\''
-            return (self.parse_main, i+1)
-        else:
-            if char == '\n':
-                self.text += ' '
+        for match in self.TOKEN_RE.finditer(text):
+            token = match.group()
+            if self.hyphen:
+                self.hyphen = False
+                if token[0] in ' \n':
+                    token = token[1:]
+                    if not token:
+                        continue
+                else:
+                    self.parts.append('-')
+            if token == '"':
+                self.parts.append("''" if self.in_quote else '``')
+                self.in_quote = not self.in_quote
+            elif token == '\n':
+                self.parts.append(' ')
+            elif token == '-' and not self.in_quote:
+                self.hyphen = True
             else:
-                self.text += char
-            return (self.parse_quote, i+1)
+                self.parts.append(token)
+
+def normalize_title(val):
+    """Normalizes the title"""
+    return {'title': val.strip('\n')}
+
+def normalize_authors(val):
+    """Normalizes the list of authors"""
+    return {'author': val.strip('\n').replace(',', ' and ')}
+
+def normalize_abstract(val):
+    """Normalizes the abstract"""
+    parser = AbstParser()
+    parser.feed(val.strip())
+    return {'abstract': parser.text}
+
+def normalize_arxivid(val):
+    """Normalizes the arXiv identifier and derives the URL and date from it"""
+    result = {'eprint': val}
+    matches = ARXIV_ID_RE.match(val)
+    if matches is None:  # old-style identifiers such as arXiv:hep-th/9901001
+        result['url'] = f'http://arxiv.org/abs/{val.partition(":")[-1]}'
+    else:
+        result['url'] = f'http://arxiv.org/abs/{(matches.group(1))}'
+        result['year'] = f'20{(matches.group(2))}'
+        result['month'] = calendar.month_abbr[int(matches.group(3))]
+    return result
+
+def normalize_doi(val):
+    """Normalizes the DOI and adds its URL"""
+    return {'doi': val, 'doi-url': f'http://dx.doi.org/{val}'}
 
-    def parse_hyphen(self, text, i):
-        """Parses the hyphen symbols in the texts"""
-        char = text[i]
-        if char not in (' ', '\n'):
-            self.text += '-'
-        return (self.parse_main, i+1)
+NORMALIZERS = {'title mathjax': normalize_title, 'authors': normalize_authors,
+               'abstract mathjax': normalize_abstract, 'tablecell arxivid': normalize_arxivid,
+               'tablecell doi': normalize_doi}
 
 def normalize(cls, dic):
     """Normalizes and returns the results of the text"""
     assert cls in dic
-    val = dic[cls]
-    result = {}
-    if cls == 'title mathjax':
-        result['title'] = val.strip('\n')
-    elif cls == 'authors':
-        result['author'] = ''
-        for char in val.strip('\n'):
-            if char == ',':
-                result['author'] += ' and '
-            else:
-                result['author'] += char
-    elif cls == 'abstract mathjax':
-        parser = AbstParser()
-        parser.feed(val.strip())
-        result['abstract'] = parser.text
+    if cls in NORMALIZERS:
+        return NORMALIZERS[cls](dic[cls])
     if cls.startswith('tablecell '):
-        char = cls.partition('tablecell ')[-1]
-        if char == 'arxivid':
-            result['eprint'] = val
-            matches = ARXIV_ID_RE.match(val)
-            result['url'] = f'http://arxiv.org/abs/{(matches.group(1))}'
-            result['year'] = f'20{(matches.group(2))}'
-            result['month'] = calendar.month_abbr[int(matches.group(3))]
-        elif char == 'doi':
-            result[char] = val
-            result['doi-url'] = f'http://dx.doi.org/{val}'
-        else:
-            result[char] = dic[cls]
-    return result
+        return {cls.partition('tablecell ')[-1]: dic[cls]}
+    return {}
 
-some_classes = ('title mathjax', 'authors', 'abstract mathjax',
-                'tablecell comments', 'tablecell arxivid', 'tablecell subjects',
-                'tablecell jref', 'tablecell doi', 'tablecell report-number',
-                'tablecell msc-classes', 'tablecell acm-classes')
+some_classes = frozenset(('title mathjax', 'authors', 'abstract mathjax',
+                          'tablecell comments', 'tablecell arxivid', 'tablecell subjects',
+                          'tablecell jref', 'tablecell doi', 'tablecell report-number',
+                          'tablecell msc-classes', 'tablecell acm-classes'))
 
 class MyHTMLParser(HTMLParser):
     """Basis for parsing text files formatted in HTML"""
@@ -193,10 +230,10 @@ class MyHTMLParser(HTMLParser):
 
     def handle_starttag(self, tag, attrs):
         """Handles the start of a tag"""
-        for attr in attrs:
-            if attr[1] in some_classes:
-                self.stack.append({'tag': tag, 'class': attr[1]})
-            if attr[1] == "descriptor":
+        for _, value in attrs:
+            if value in some_classes:
+                self.stack.append({'tag': tag, 'class': value})
+            elif value == "descriptor":
                 self.in_descriptor = True
 
     def handle_endtag(self, tag):
@@ -204,53 +241,684 @@ class MyHTMLParser(HTMLParser):
         if self.in_descriptor and tag == "span":
             self.in_descriptor = False
         if self.stack and tag == self.stack[-1]['tag']:
-            stack = self.stack.pop()
-            self.item.add(normalize(stack['class'], self.tmp))
+            cls = self.stack.pop()['class']
+            if cls in self.tmp:
+                self.item.add(normalize(cls, {cls: ''.join(self.tmp.pop(cls))}))
 
     def handle_data(self, data):
         """Handles the text contents of the tags"""
-        for char in some_classes:
-            if self.in_descriptor:
+        if self.stack and not self.in_descriptor:
+            self.tmp.setdefault(self.stack[-1]['class'], []).append(data)
+
+class AtomParser():
+    """Basis for parsing the entries of the arXiv API, which are formatted in Atom. The API
+    only gives the codes of the subjects, such as cs.DL, not their names"""
+    NAMESPACES = {'atom': 'http://www.w3.org/2005/Atom', 'arxiv': 'http://arxiv.org/schemas/atom'}
+    FIELDS = (('title mathjax', 'atom:title'), ('abstract mathjax', 'atom:summary'),
+              ('tablecell comments', 'arxiv:comment'), ('tablecell jref', 'arxiv:journal_ref'),
+              ('tablecell doi', 'arxiv:doi'))
+
+    def __init__(self):
+        self.item = BibItem('article')
+
+    def feed(self, data):
+        """Receives an Atom entry and adds its fields in the same way as MyHTMLParser"""
+        self.add_entry(parse_atom(data))
+
+    def add_entry(self, entry):
+        """Adds the fields of a parsed Atom entry"""
+        dic = {}
+        for cls, path in self.FIELDS:
+            text = entry.findtext(path, None, self.NAMESPACES)
+            if text is not None:
+                dic[cls] = text if cls == 'abstract mathjax' else ' '.join(text.split())
+        dic['authors'] = ', '.join(name.text or '' for name in
+                                   entry.iterfind('atom:author/atom:name', self.NAMESPACES))
+        dic['tablecell arxivid'] = 'arXiv:' + arxiv_api_id(entry.findtext('atom:id', '', self.NAMESPACES))
+        dic['tablecell subjects'] = '; '.join(category.get('term', '') for category in
+                                              entry.iterfind('atom:category', self.NAMESPACES))
+        # in the order of the abstract page, so that both write the fields in the same order
+        for cls in ('title mathjax', 'authors', 'abstract mathjax', 'tablecell comments',
+                    'tablecell subjects', 'tablecell arxivid', 'tablecell jref', 'tablecell doi'):
+            if cls in dic:
+                self.item.add(normalize(cls, dic))
+
+    def close(self):
+        """Finishes parsing"""
+
+def parse_atom(text):
+    """Returns the root element of an Atom document of the arXiv API. Raises ValueError if
+    the document is malformed"""
+    import xml.etree.ElementTree as ET  # pylint: disable=import-outside-toplevel
+    try:
+        return ET.fromstring(text)
+    except ET.ParseError as error:
+        raise ValueError(f'malformed arXiv API response: {error}') from error
+
+def arxiv_api_id(entry_id):
+    """Returns the arXiv identifier without its version from the id of an Atom entry"""
+    return re.sub(r'v\d+$', '', entry_id.split('/abs/', 1)[-1])
+
+class Metrics():
+    """Timers of the phases of a run, and counters and latency histograms of the providers"""
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.providers = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Adds the time spent in the with block to the timer of the phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        """Adds the seconds to the timer of the phase"""
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def count(self, provider, name, amount=1):
+        """Adds the amount to the counter of the provider"""
+        with self.lock:
+            counters = self.providers.setdefault(provider, {})
+            counters[name] = counters.get(name, 0) + amount
+
+    def observe(self, provider, seconds):
+        """Adds the latency of a request to the histogram of the provider"""
+        with self.lock:
+            histogram = self.providers.setdefault(provider, {}).setdefault(
+                'latency', {'count': 0, 'sum': 0, 'max': 0, 'buckets': [0] * len(self.LATENCY_BUCKETS)})
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+            histogram['buckets'][next(i for i, bound in enumerate(self.LATENCY_BUCKETS) if seconds <= bound)] += 1
+
+    def quantile(self, histogram, fraction):
+        """Returns the upper bound of the bucket holding the given fraction of the latencies"""
+        seen = 0
+        for bound, count in zip(self.LATENCY_BUCKETS, histogram['buckets']):
+            seen += count
+            if seen >= fraction * histogram['count']:
+                return bound
+        return float('inf')
+
+    def as_dict(self):
+        """Returns the metrics in a form that can be dumped as JSON"""
+        with self.lock:
+            providers = json.loads(json.dumps(self.providers))
+        for counters in providers.values():
+            if 'latency' in counters:
+                counters['latency']['buckets'] = dict(zip(
+                    [str(bound) for bound in self.LATENCY_BUCKETS], counters['latency']['buckets']))
+        return {'phases': dict(self.phases), 'providers': providers}
+
+    def report(self):
+        """Prints the metrics"""
+        print('\nTime spent in each phase:')
+        for name, seconds in self.phases.items():
+            print(f'{name:<24} {seconds:9.3f} s')
+        print('\nRequests to each bibliography:')
+        for provider, counters in sorted(self.providers.items(), key=lambda item: item[0].lower()):
+            line = ', '.join(f'{value:.3f} s {name[:-8]}' if name.endswith('_seconds')
+                             else f'{value} {name.replace("_", " ")}'
+                             for name, value in sorted(counters.items()) if name != 'latency')
+            print(f'{provider}: {line}')
+            if 'latency' in counters:
+                histogram = counters['latency']
+                print(f'{provider}: latency mean {histogram["sum"] / histogram["count"]:.3f} s, '
+                      f'p50 <= {self.quantile(histogram, 0.5)} s, p95 <= {self.quantile(histogram, 0.95)} s, '
+                      f'max {histogram["max"]:.3f} s')
+
+    def scope(self, provider):
+        """Returns the metrics of the provider"""
+        return MetricsScope(self, provider)
+
+class MetricsScope():
+    """The counters and latency histogram of one provider"""
+    def __init__(self, metrics, provider):
+        self.metrics = metrics
+        self.provider = provider
+
+    def count(self, name, amount=1):
+        """Adds the amount to the counter"""
+        self.metrics.count(self.provider, name, amount)
+
+    def observe(self, seconds):
+        """Adds the latency of a request to the histogram"""
+        self.metrics.observe(self.provider, seconds)
+
+def load_json_index(path):
+    """Loads an index file written by save_json_index, or returns an empty index"""
+    if path and os.path.isfile(path):
+        try:
+            with open(path, encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            print(f'\n(ignoring unreadable index file {path}.)')
+    return {}
+
+@contextlib.contextmanager
+def open_replacement(path, mode='wb', **options):
+    """Yields a temporary file which then replaces the file with its permissions, so that the
+    file is never left half written. The temporary file is removed after an error"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = tempfile.NamedTemporaryFile(mode, dir=directory, prefix='.' + os.path.basename(path),
+                                      delete=False, **options)
+    try:
+        with tmp:
+            yield tmp
+        os.chmod(tmp.name, os.stat(path).st_mode if os.path.isfile(path) else 0o644)
+        os.replace(tmp.name, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp.name)
+        raise
+
+def save_json_index(path, index):
+    """Writes an index file through a temporary file which then replaces it"""
+    if not path:
+        return
+    with open_replacement(path, 'w', encoding='utf-8') as tmp:
+        json.dump(index, tmp)
+
+class BibFile():
+    """Collects the new entries of a BibTeX file and writes them all at once behind the
+    existing contents of the file"""
+    REWRITES = False  # whether flush moves the existing entries
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = []
+
+    def add(self, key, entry):
+        """Adds the entry to the ones that will be written"""
+        self.pending.append((key, entry.encode('utf-8')))
+
+    def flush(self):
+        """Writes the existing and the new entries to a temporary file which then replaces
+        the BibTeX file, so that the BibTeX file is never left half written. Returns the
+        byte offset and length of each new entry by key"""
+        if not self.pending:
+            return {}
+        with open_replacement(self.path) as tmp:
+            if os.path.isfile(self.path):
+                with open(self.path, 'rb') as file:
+                    shutil.copyfileobj(file, tmp)
+                    if file.tell():
+                        file.seek(-1, os.SEEK_END)
+                        if file.read(1) != b'\n':
+                            tmp.write(b'\n')
+            offsets = {}
+            for key, entry in self.pending:
+                offsets[key] = [tmp.tell(), len(entry)]
+                tmp.write(entry)
+        self.pending = []
+        return offsets
+
+RUN_RECORD = struct.Struct('<II')  # key length, entry length
+
+def spill_run(run):
+    """Sorts the (key, entry) pairs by key and writes them to a temporary file"""
+    run.sort(key=lambda item: item[0])
+    file = tempfile.TemporaryFile()
+    for key, entry in run:
+        file.write(RUN_RECORD.pack(len(key), len(entry)) + key + entry)
+    return file
+
+def iterate_run(run):
+    """Yields the (key, entry) pairs of a sorted run, kept in memory or in a temporary file"""
+    if isinstance(run, list):
+        yield from run
+        return
+    run.seek(0)
+    while True:
+        record = run.read(RUN_RECORD.size)
+        if not record:
+            return
+        key_length, entry_length = RUN_RECORD.unpack(record)
+        yield run.read(key_length), run.read(entry_length)
+
+class SortedBibFile(BibFile):
+    """Writes the existing and new entries of a BibTeX file sorted by key, with the
+    @string, @preamble and @comment blocks in front and the cross-referenced entries last"""
+    REWRITES = True
+
+    def entries(self, data):
+        """Yields the (key, entry) pairs of the blocks of the existing file in data and then
+        of the new entries. The key is None for the text in front of the first block and
+        for the blocks that are not entries"""
+        start = 0
+        for match in chain(BIBTEX_BLOCK_RE.finditer(data), [None]):
+            end = len(data) if match is None else match.start()
+            if end > start:
+                entry = return_bibtex().match(data, start)
+                yield entry and entry.group(1), bytes(data[start:end]).rstrip() + b'\n\n'
+            start = end
+        for key, entry in self.pending:
+            yield key.encode('utf-8'), entry.rstrip() + b'\n\n'
+
+    def sorted_runs(self, targets):
+        """Returns the header of the existing file, the text in front of the first entry and
+        the blocks that are not entries, and the sorted runs of the entries, and adds the keys
+        of the entries that other entries refer to to targets"""
+        size = os.path.getsize(self.path) if os.path.isfile(self.path) else 0
+        runs, run, run_size = [], [], 0
+        header = []
+        with open_buffer(self.path, size) if size else contextlib.nullcontext(b'') as data:
+            for key, entry in self.entries(data):
+                if key is None:
+                    header.append(entry)
+                    continue
+                targets.update(CROSSREF_RE.findall(entry))
+                run.append((key, entry))
+                run_size += len(key) + len(entry)
+                if run_size >= MERGE_RUN_BYTES:
+                    runs.append(spill_run(run))
+                    run, run_size = [], 0
+        run.sort(key=lambda item: item[0])
+        return b''.join(header).lstrip(), runs + [run]
+
+    def flush(self):
+        """Writes the sorted entries to a temporary file which then replaces the BibTeX file.
+        Returns the byte offset and length of every entry by key"""
+        if not self.pending:
+            return {}
+        targets = set()
+        header, runs = self.sorted_runs(targets)
+        offsets = {}
+        with open_replacement(self.path, buffering=2**20) as tmp:
+            tmp.write(header)
+            for cross_referenced in (False, True):
+                previous = None
+                # the merge keeps the order of the runs for equal keys, so the existing entry wins
+                for key, entry in heapq.merge(*map(iterate_run, runs), key=lambda item: item[0]):
+                    duplicate, previous = key == previous, key
+                    if duplicate or (key in targets) != cross_referenced:
+                        continue
+                    offsets[key.decode('utf-8')] = [tmp.tell(), len(entry)]
+                    tmp.write(entry)
+        for run in runs[:-1]:
+            run.close()
+        self.pending = []
+        return offsets
+
+class BibSnapshot():
+    """A memory mapped binary snapshot of the index of the BibTeX files, in which the keys
+    of an unchanged file are looked up by binary search"""
+    MAGIC = b'GBSNAP02'
+    HEADER = struct.Struct('<8sII')  # magic, number of files, number of entries
+    FILE = struct.Struct('<dQIIIIH')  # mtime, size, first entry, number of entries, key offset, key bytes, path length
+    ENTRY = struct.Struct('<IHQI')  # key offset within the keys of the file, key length, entry offset, entry length
+
+    def __init__(self, path=None):
+        self.files = {}
+        self.buffer = b''
+        self.table = 0
+        self.blob = 0
+        if path and os.path.isfile(path) and os.path.getsize(path):
+            try:
+                with open(path, 'rb') as file:
+                    self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.load()
+            except (OSError, ValueError, struct.error):
+                print(f'\n(ignoring unreadable snapshot file {path}.)')
+                self.close()
+
+    def load(self):
+        """Reads the header and the files of the snapshot; the entries are left in the buffer"""
+        magic, file_count, entry_count = self.HEADER.unpack_from(self.buffer, 0)
+        if magic != self.MAGIC:
+            raise ValueError('not a snapshot file')
+        position = self.HEADER.size
+        for _ in range(file_count):
+            mtime, size, first, count, key_offset, key_size, length = self.FILE.unpack_from(self.buffer, position)
+            position += self.FILE.size
+            path = self.buffer[position:position + length].decode('utf-8')
+            position += length
+            self.files[path] = {'mtime': mtime, 'size': size, 'first': first, 'count': count,
+                                'key_offset': key_offset, 'key_size': key_size}
+        self.table = position
+        self.blob = position + entry_count * self.ENTRY.size
+        if self.blob > len(self.buffer):
+            raise ValueError('truncated snapshot file')
+
+    def entry_at(self, keys, row):
+        """Returns the encoded key, the byte offset and the length of the entry in the row of
+        the table, whose file has its keys at the offset keys of the buffer"""
+        key_offset, key_length, offset, length = self.ENTRY.unpack_from(
+            self.buffer, self.table + row * self.ENTRY.size)
+        return self.buffer[keys + key_offset:keys + key_offset + key_length], offset, length
+
+    def find(self, path, key):
+        """Returns the byte offset and length of the entry with the key in the BibTeX file, or
+        None if the file has no such entry"""
+        target = key.encode('utf-8')
+        keys = self.blob + self.files[path]['key_offset']
+        low = self.files[path]['first']
+        end = high = low + self.files[path]['count']
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry_at(keys, middle)[0] < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < end:
+            found, offset, length = self.entry_at(keys, low)
+            if found == target:
+                return offset, length
+        return None
+
+    def table_of(self, path):
+        """Returns the rows of the table for the entries of the BibTeX file, and its keys"""
+        indexed = self.files[path]
+        start = self.table + indexed['first'] * self.ENTRY.size
+        keys = self.blob + indexed['key_offset']
+        return (self.buffer[start:start + indexed['count'] * self.ENTRY.size],
+                self.buffer[keys:keys + indexed['key_size']])
+
+    def rows(self, path):
+        """Returns the (key offset, key length, entry offset, entry length) rows of the table
+        for the entries of the BibTeX file, and its keys"""
+        table, keys = self.table_of(path)
+        return self.ENTRY.iter_unpack(table), keys
+
+    def keys(self, path):
+        """Returns the keys of the entries of the BibTeX file in order"""
+        rows, blob = self.rows(path)
+        return [blob[key_offset:key_offset + key_length].decode('utf-8')
+                for key_offset, key_length, _, _ in rows]
+
+    def entries(self, path):
+        """Returns the byte offset and length of each entry of the BibTeX file by key"""
+        rows, blob = self.rows(path)
+        return {sys.intern(blob[key_offset:key_offset + key_length].decode('utf-8')): [offset, length]
+                for key_offset, key_length, offset, length in rows}
+
+    def close(self):
+        """Unmaps the snapshot file"""
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.buffer = b''
+        self.files = {}
+
+def pack_snapshot_entries(entries):
+    """Returns the BibSnapshot table rows of the entries, given by key with their byte offset
+    and length, sorted by key, and their keys"""
+    rows = []
+    keys = bytearray()
+    for key, offset, length in sorted((key.encode('utf-8'), offset, length)
+                                      for key, (offset, length) in entries.items()):
+        rows.append(BibSnapshot.ENTRY.pack(len(keys), len(key), offset, length))
+        keys += key
+    return b''.join(rows), bytes(keys)
+
+def save_bib_snapshot(path, files, base=None):
+    """Writes the index of the BibTeX files as a BibSnapshot through a temporary file which
+    then replaces it. The files without entries are copied as they are from the base
+    snapshot, which is closed before it is replaced"""
+    if base is None:
+        base = BibSnapshot()
+    file_records = []
+    table = []
+    blob = []
+    rows = key_size = 0
+    for full_path, indexed in files.items():
+        if 'entries' in indexed:
+            chunk, keys = pack_snapshot_entries(indexed['entries'])
+        else:
+            chunk, keys = base.table_of(full_path)
+        count = len(chunk) // BibSnapshot.ENTRY.size
+        table.append(chunk)
+        blob.append(keys)
+        file_records.append(BibSnapshot.FILE.pack(indexed['mtime'], indexed['size'], rows, count, key_size,
+                                                  len(keys), len(full_path.encode('utf-8'))) + full_path.encode('utf-8'))
+        rows += count
+        key_size += len(keys)
+    base.close()
+    with open_replacement(path) as tmp:
+        tmp.write(BibSnapshot.HEADER.pack(BibSnapshot.MAGIC, len(file_records), rows))
+        for chunks in (file_records, table, blob):
+            tmp.writelines(chunks)
+
+class BibDatabase():
+    """Indexes the entries of the BibTeX files by key, parsing only the files that have
+    changed since the snapshot"""
+    def __init__(self, index_path=None, writer_class=BibFile):
+        self.index_path = index_path
+        self.snapshot = BibSnapshot(index_path)
+        self.files = {}
+        self.unchanged = []
+        self.owners = {}
+        self.writers = {}
+        self.writer_class = writer_class
+
+    def __contains__(self, key):
+        return key in self.owners or self.locate(key) is not None
+
+    def __iter__(self):
+        keys = dict.fromkeys(self.owners)
+        for path in self.unchanged:
+            keys.update(dict.fromkeys(self.snapshot.keys(path)))
+        return iter(keys)
+
+    def read_all(self, paths, processes=1):
+        """Indexes the BibTeX files that have changed, in parallel processes if they are large
+        enough. Returns whether each BibTeX file exists"""
+        full_paths = [os.path.abspath(path) for path in paths]
+        found = [os.path.isfile(full_path) for full_path in full_paths]
+        stale = []
+        for full_path in dict.fromkeys(full_path for full_path, exists in zip(full_paths, found) if exists):
+            if is_current(self.files.get(full_path), full_path):
                 continue
-            if self.stack and self.stack[-1]['class'] == char:
-                self.tmp[char] = self.tmp.get(char, '') + data
+            if is_current(self.snapshot.files.get(full_path), full_path):
+                if full_path not in self.unchanged:
+                    self.unchanged.append(full_path)
+            else:
+                stale.append(full_path)
+        for full_path, indexed in zip(stale, map_files(index_bibtex_file, processes, stale)):
+            self.add_indexed(full_path, indexed)
+        return found
+
+    def add_indexed(self, full_path, indexed):
+        """Keeps the index entry of a BibTeX file that has been parsed or written"""
+        if full_path in self.unchanged:
+            self.unchanged.remove(full_path)
+        self.files[full_path] = indexed
+        for key in indexed['entries']:
+            self.owners.setdefault(key, full_path)
+
+    def locate(self, key):
+        """Returns the path, byte offset and length of the entry with the key in the unchanged
+        BibTeX files, or None"""
+        for path in self.unchanged:
+            found = self.snapshot.find(path, key)
+            if found is not None:
+                return (path,) + found
+        return None
+
+    def entry(self, key):
+        """Returns the text of the entry with the key as it is in its BibTeX file"""
+        if key in self.owners:
+            path = self.owners[key]
+            offset, length = self.files[path]['entries'][key]
+        elif self.locate(key) is not None:
+            path, offset, length = self.locate(key)
+        else:
+            raise KeyError(key)
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            return file.read(length).decode('utf-8')
+
+    def add(self, path, key, entry):
+        """Adds the entry to the BibTeX file, unless an entry with its key is already known"""
+        if key in self:
+            return False
+        full_path = os.path.abspath(path)
+        self.owners[key] = full_path
+        self.writers.setdefault(full_path, self.writer_class(path)).add(key, entry)
+        return True
+
+    def flush(self):
+        """Writes the new entries of all of the BibTeX files and updates the snapshot file"""
+        for full_path, writer in self.writers.items():
+            offsets = writer.flush()
+            if offsets:
+                if writer.REWRITES:
+                    self.add_indexed(full_path, {'entries': {}})
+                elif full_path in self.unchanged:
+                    self.add_indexed(full_path, {'entries': self.snapshot.entries(full_path)})
+                stat = os.stat(full_path)
+                indexed = self.files.get(full_path, {'entries': {}})
+                indexed['mtime'] = stat.st_mtime
+                indexed['size'] = stat.st_size
+                indexed['entries'].update(offsets)
+                self.files[full_path] = indexed
+        self.writers = {}
+        if not self.files or not self.index_path:
+            return
+        # other databases may have updated the snapshot since it was loaded, so only the
+        # BibTeX files parsed or written by this one are replaced in it
+        snapshot = BibSnapshot(self.index_path)
+        files = {path: indexed for path, indexed in snapshot.files.items()
+                 if path not in self.files and os.path.isfile(path)}
+        files.update(self.files)
+        self.snapshot.close()
+        save_bib_snapshot(self.index_path, files, snapshot)
+        self.snapshot = BibSnapshot(self.index_path)
 
 def return_bibtex():
-    """Compiles and returns the BibTeX file citations"""
-    re_bibtex_citations = re.compile(r'@.*\{([^,]*),')
-    return re_bibtex_citations
-
-def read_existing_file(name_bibtex_file):
-    """Reads the existing BibTeX file or create a new one if it is not found"""
-    if os.path.isfile(name_bibtex_file):
-        print(f'\nReading existing BibTeX file {name_bibtex_file}')
-        with (open(name_bibtex_file, encoding="utf-8")) as file:
-            for _, line in enumerate(file):
-                for match in re.finditer(return_bibtex(), line):
-                    for key in match.groups():
-                        known_keys.add(key)
-
-    else:
-        print(f'\nBibTeX file {name_bibtex_file} not found, will try to create it.')
-
-def read_all_existing_files():
-    """Compiles and reads all of the existing bibliography BibTex files"""
-    read_existing_file(arxiv_bibtex_file)
-    read_existing_file(base_bibtex_file)
-    read_existing_file(cogprints_bibtex_file)
-    read_existing_file(dblp_bibtex_file)
-    read_existing_file(jstor_bibtex_file)
-    read_existing_file(microsoft_bibtex_file)
-    read_existing_file(springer_bibtex_file)
-
-    print('\nThe following {name} keys have been found in your BibTeX files:')
-    for key in known_keys:
-        print (f'{key}')
+    """Returns the compiled BibTeX file citations"""
+    return BIBTEX_ENTRY_RE
 
 def return_tex_citation():
-    """Compiles and returns the LateX citations"""
-    re_tex_citation = re.compile(r'(?:cite|citep|citet|fullciteown|autocite|textcite)\{([^}]+)}')
-    return re_tex_citation
+    """Returns the compiled LateX citations"""
+    return TEX_CITATION_RE
+
+def scan_tex(data):
+    """Returns the citation keys of the UTF-8 encoded LaTeX text in order of appearance"""
+    keys = {}
+    for match in return_tex_citation().finditer(data):
+        for key in match.group(1).decode('utf-8').split(','):
+            key = key.strip()
+            if key:
+                keys[key] = None
+    return list(keys)
+
+@contextlib.contextmanager
+def open_buffer(path, size):
+    """Yields the contents of the file of the given size as a bytes-like buffer, memory mapped
+    if the file is large, so that it can be hashed and searched as a whole without copying
+    it"""
+    with open(path, 'rb') as file:
+        if size < MMAP_THRESHOLD:
+            yield file.read()
+        else:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield buffer
+
+def is_current(indexed, full_path):
+    """Returns whether the index entry of the file is up to date, judging by the
+    modification time and size of the file"""
+    if indexed is None:
+        return False
+    stat = os.stat(full_path)
+    return indexed['mtime'] == stat.st_mtime and indexed['size'] == stat.st_size
+
+def index_tex_file(full_path, digest=None):
+    """Returns the index entry of the LaTeX file with its citation keys. If the file still
+    has the given hash, it is not scanned and the keys of the entry are None"""
+    stat = os.stat(full_path)
+    with open_buffer(full_path, stat.st_size) as data:
+        indexed = {'keys': None, 'mtime': stat.st_mtime, 'size': stat.st_size,
+                   'hash': hashlib.sha1(data).hexdigest()}
+        if indexed['hash'] != digest:
+            indexed['keys'] = scan_tex(data)
+    return indexed
+
+def index_bibtex_file(full_path):
+    """Returns the index entry of the BibTeX file with the byte offset and length of each
+    entry by key"""
+    stat = os.stat(full_path)
+    with open_buffer(full_path, stat.st_size) as data:
+        starts = [(match.start(), match.group(1).decode('utf-8'))
+                  for match in return_bibtex().finditer(data)]
+        ends = [start for start, _ in starts[1:]] + [len(data)]
+    return {'mtime': stat.st_mtime, 'size': stat.st_size,
+            'entries': {key: [start, end - start] for (start, key), end in zip(starts, ends)}}
+
+def map_files(function, processes, paths, *arguments):
+    """Calls the function on each of the files and the corresponding items of the other
+    arguments, and returns the results in order. The files are split across a pool of
+    processes if there are enough of them, or enough bytes, to make up for starting it"""
+    processes = processes or os.cpu_count() or 1
+    if processes > 1 and len(paths) > 1 and (
+            len(paths) >= PARALLEL_SCAN_FILES or
+            sum(os.path.getsize(path) for path in paths) >= PARALLEL_SCAN_BYTES):
+        from concurrent.futures import ProcessPoolExecutor  # pylint: disable=import-outside-toplevel
+        with ProcessPoolExecutor(processes) as executor:
+            return list(executor.map(function, paths, *arguments,
+                                     chunksize=max(1, len(paths) // (4 * processes))))
+    return list(map(function, paths, *arguments))
+
+class TexIndex():
+    """Keeps the citation keys found in each LaTeX file, together with the modification
+    time, size and hash of the file, so that only changed files are scanned again"""
+    def __init__(self, index_path=None):
+        self.index_path = index_path
+        self.files = load_json_index(index_path)
+
+    def update(self, paths, processes=1):
+        """Scans the LaTeX files that have changed since they were indexed, in parallel
+        processes if there are enough of them, and returns the citation keys of each file. A
+        file whose hash has not changed keeps its keys without being scanned again"""
+        full_paths = [os.path.abspath(path) for path in paths]
+        stale = list(dict.fromkeys(full_path for full_path in full_paths
+                                   if not is_current(self.files.get(full_path), full_path)))
+        digests = [self.files.get(full_path, {}).get('hash') for full_path in stale]
+        for full_path, indexed in zip(stale, map_files(index_tex_file, processes, stale, digests)):
+            if indexed['keys'] is None:
+                indexed['keys'] = self.files[full_path]['keys']
+            self.files[full_path] = indexed
+        return [self.files[full_path]['keys'] for full_path in full_paths]
+
+    def under(self, directory):
+        """Returns the indexed LaTeX files in the directory and its subdirectories"""
+        prefix = os.path.join(os.path.abspath(directory), '')
+        return {path: indexed for path, indexed in self.files.items() if path.startswith(prefix)}
+
+    def save(self):
+        """Writes the index file, leaving out the LaTeX files that no longer exist"""
+        self.files = {path: indexed for path, indexed in self.files.items() if os.path.isfile(path)}
+        save_json_index(self.index_path, self.files)
+
+class TexFiles():
+    """The .tex files of a (sub)directory, leaving out the excluded directories and the
+    ignored files, the index of their citation keys, and the number of processes that scan
+    them (None for one per CPU)"""
+    def __init__(self, directory='./', index_path=None, exclude=(), ignore=(), processes=1):
+        self.directory = directory
+        self.index = TexIndex(index_path)
+        self.exclude_directories = set(EXCLUDE_DIRECTORIES) | set(exclude)
+        self.ignore_tex_files = set(ignore)
+        self.processes = processes
+
+    def is_tex_file(self, name):
+        """Returns whether the file name is of a .tex file that should be read"""
+        return name.endswith('.tex') and name not in self.ignore_tex_files
+
+    def walk(self):
+        """Returns the paths of all the .tex files in the directory and its subdirectories"""
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            dirnames[:] = sorted(d for d in dirnames if d not in self.exclude_directories)
+            paths.extend(os.path.join(dirpath, f) for f in sorted(filenames) if self.is_tex_file(f))
+        return paths
 
 def find_keys(name, name_keys):
     """Finds the bibliography keys in the LaTeX files"""
@@ -258,219 +926,1459 @@ def find_keys(name, name_keys):
     for key in name_keys:
         print (f'{key}')
 
-def find_all_keys():
-    """Calls on the previous functions of finding the keys of all the bibliographies"""
-    find_keys('arXiv', arxiv_keys)
-    find_keys('BASE', base_keys)
-    find_keys('Cogprints', cogprints_keys)
-    find_keys('DBLP', dblp_keys)
-    find_keys('JSTOR', jstor_keys)
-    find_keys('Microsoft Research', microsoft_keys)
-    find_keys('SpringerLink', springer_keys)
-    find_keys('unused', unused_keys)
-
-def read_latex():
-    """Reads the LateX documents and adds the corresponding keys"""
-    print('\nReading your LaTeX documents:')
-
-    return_tex_citation()
-
-    for dirpath, dirnames, filenames in os.walk(TEX_FILES_DIRECTORY):
-        exclude = set([])
-        list(set(dirnames) - exclude)
-
-        for filename in [f for f in filenames if f.endswith('.tex') and
-                         f not in ignore_tex_files]:
-            print (f'{filename}')
-            with open(Path(dirpath) / filename, encoding="utf-8") as file:
-                for _, line in enumerate(file):
-                    for match in re.finditer(return_tex_citation(), line):
-                        for group in match.groups():
-                            for key in group.split(','):
-                                if key.strip().startswith('Arxiv:'):
-                                    arxiv_keys.add(key.strip())
-                                elif key.strip().startswith('BASE:'):
-                                    base_keys.add(key.strip())
-                                elif key.strip().startswith('Cogprints:'):
-                                    cogprints_keys.add(key.strip())
-                                elif key.strip().startswith('DBLP:'):
-                                    dblp_keys.add(key.strip())
-                                elif key.strip().startswith('JSTOR:'):
-                                    jstor_keys.add(key.strip())
-                                elif key.strip().startswith('Microsoft:'):
-                                    microsoft_keys.add(key.strip())
-                                elif key.strip().startswith('Springer:'):
-                                    springer_keys.add(key.strip())
-                                else:
-                                    unused_keys.add(key.strip())
-
-    find_all_keys()
-
 def compile_bibtex_items():
-    """Compiles the BibTeX items"""
-    re_bibtex_items = re.compile(r'(@[a-zA-Z]+\{[^@]*\n})', re.DOTALL)
-    return re_bibtex_items
+    """Returns the compiled BibTeX items"""
+    return BIBTEX_ITEMS_RE
 
 def compile_bibtex_item_key():
-    """Compiles the BibTeX item key"""
-    re_bibtex_item_key = re.compile(r'@[a-zA-Z]+\{([^,]+),\s*', re.DOTALL)
-    return re_bibtex_item_key
+    """Returns the compiled BibTeX item key"""
+    return BIBTEX_ITEM_KEY_RE
 
 def find_missing_keys(name):
     """Finds the missing keys from the bibliography"""
     print(f'\nFetching BibTeX records for missing keys from {name}:')
-    compile_bibtex_items()
-    compile_bibtex_item_key()
 
-def check_missing_keys(name_bibtex_file, name_keys, name):
-    """Checks for missing keys in the BibTeX file"""
-    if not os.path.isfile(name_bibtex_file) and name_keys == set():
+def check_missing_keys(name_bibtex_file, name_keys, name, known_keys=()):
+    """Checks for missing keys in the BibTeX file, and returns the keys that are not known
+    yet"""
+    missing = {key for key in name_keys if key not in known_keys}
+    if not os.path.isfile(name_bibtex_file) and not missing:
         print (f'\nYou do not have a {name} BibTeX file, nothing needs to be fetched. :-)')
-    elif name_keys == set():
+    elif not missing:
         print(f'\nYour {name} BibTeX file is up to date, nothing needs to be fetched. :-)')
     else:
         find_missing_keys(name)
-    return name_keys
-
-def open_bibtex_file_same_key(name_bibtex_file, name_bibtex_file_content, fetched_name_keys, name):
-    """Opens the BibTeX file for the bibliography with the same LaTeX citation key and
-    writes it to our BibTeX file if it is not already there"""
-    with open(name_bibtex_file, 'a', encoding="utf8") as file:
-        for match in re.finditer(compile_bibtex_items(), name_bibtex_file_content):
-            for bibtex_item in match.groups():
-                key = re.match(compile_bibtex_item_key(), bibtex_item).group(1)
-                if key not in fetched_name_keys | known_keys:
-                    file.write(bibtex_item)
-                    file.write('\n\n')
-                    fetched_name_keys.add(key)
+    return missing
+
+def arxiv_url(key):
+    """Returns the arXiv URL of the citation key"""
+    return f'https://arxiv.org/abs/{key[6:]}'
+
+class RateLimiter():
+    """Token buckets that let on average `rate` requests per second through to each host,
+    in bursts of at most `burst` requests; `host_rates` overrides the rate of single hosts"""
+    def __init__(self, rate=4.0, host_rates=None, burst=1):
+        self.rate = rate
+        self.host_rates = {} if host_rates is None else host_rates
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def rate_of(self, host):
+        """Returns the number of requests per second allowed to the host"""
+        return self.host_rates.get(host, self.rate)
+
+    def acquire(self, host):
+        """Waits until the next request to the host may be sent"""
+        rate = self.rate_of(host)
+        if not rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * rate) - 1
+            self.buckets[host] = (tokens, now)
+        if tokens < 0:
+            time.sleep(-tokens / rate)
+
+class CircuitBreaker():
+    """Stops the requests to a provider after `threshold` failures in a row, and lets one
+    request through again every `reset_after` seconds to check if it has recovered"""
+    def __init__(self, threshold=5, reset_after=60):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Returns whether a request to the provider may be sent"""
+        with self.lock:
+            if self.failures < self.threshold:
+                return True
+            if time.monotonic() - self.opened >= self.reset_after:
+                self.opened = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        """Records a successful request"""
+        with self.lock:
+            self.failures = 0
+
+    def failure(self):
+        """Records a failed request"""
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.monotonic()
+
+class Provider():
+    """Describes a bibliography website: the prefix of its keys, how their records are
+    requested and split, and how they are written ('entry', 'entries' or 'crossref')"""
+    headers = {}  # headers of every request
+    rate = None  # maximum number of requests per second to the website, if it has its own
+
+    def __init__(self, name, prefix, key_url, bibtex_file, writer='crossref'):
+        self.name = name
+        self.prefix = prefix
+        self.key_url = key_url
+        self.bibtex_file = bibtex_file
+        self.writer = writer
+        self.batch_size = 1
+        self.breaker = CircuitBreaker()
+
+    def cache_name(self):
+        """Returns the name under which the records are cached"""
+        return self.name
+
+    def url(self, keys):
+        """Returns the URL requesting the records of the keys"""
+        return self.key_url(keys[0])
+
+    def batchable(self, key):  # pylint: disable=unused-argument
+        """Returns whether the key may be requested in a batch together with other keys"""
+        return True
+
+    def host(self):
+        """Returns the host that the requests are sent to"""
+        return urlsplit(self.url([self.prefix])).netloc
+
+    def split(self, keys, content):
+        """Splits the response to the request of the keys into the record of each key"""
+        return {keys[0]: content}
+
+    def parser(self, keys):
+        """Returns the parser receiving the response to the request of the keys"""
+        return ResponseParser(self, keys)
+
+    def bibtex_entries(self, cited_key, record):
+        """Returns the (key, entry) pairs of the BibTeX entries in the record of the cited key,
+        or an empty list if it has none, such as an error page. The entry of an 'entry'
+        record is renamed to the cited key"""
+        if self.writer == 'entry':
+            items = [record.rstrip('\n')]
+        else:
+            items = [item for match in compile_bibtex_items().finditer(record) for item in match.groups()]
+            if not items and compile_bibtex_item_key().match(record.strip()):
+                items = [record.strip()]  # a single entry on one line, as Crossref writes it
+        matches = [compile_bibtex_item_key().match(item) for item in items]
+        if any(match is None for match in matches):
+            return []
+        if self.writer == 'entry':
+            return [(cited_key, f'{items[0][:matches[0].start(1)]}{cited_key}{items[0][matches[0].end(1):]}')]
+        return [(match.group(1), item) for item, match in zip(items, matches)]
+
+class TemplateProvider(Provider):
+    """A provider described by a specification, such as a "[provider NAME]" section of the
+    configuration file or a plugin, which is checked when the provider is created"""
+    RESPONSES = ('bibtex', 'json')
+    WRITERS = ('entry', 'entries', 'crossref')
+
+    def __init__(self, name, spec):
+        if not spec.get('prefix') or not spec.get('url'):
+            raise ValueError(f'provider {name} needs a prefix and a url')
+        Provider.__init__(self, name, spec['prefix'], self.template_url,
+                          spec.get('bibtex_file', f'{name.lower()}.bib'), spec.get('writer', 'crossref'))
+        self.template = spec['url']
+        self.response = spec.get('response', 'bibtex')
+        self.field = spec.get('field', '')
+        self.batch_size = int(spec.get('batch_size', 1))
+        self.rate = float(spec['rate']) if spec.get('rate') else None
+        self.headers = {'Accept': spec['accept']} if spec.get('accept') else {}
+        if self.writer not in self.WRITERS or self.response not in self.RESPONSES:
+            raise ValueError(f'provider {name} has an unknown writer or response type')
+        if self.batch_size > 1 and (self.response != 'json' or '{ids}' not in self.template):
+            raise ValueError(f'provider {name} needs {{ids}} in its url and a JSON response for batches')
+        try:
+            self.host()
+        except (KeyError, IndexError, ValueError) as error:
+            raise ValueError(f'provider {name} has an invalid url template {self.template}') from error
+
+    def template_url(self, key):
+        """Returns the URL of the record of the citation key"""
+        return self.template.format(id=key[len(self.prefix):], ids=key[len(self.prefix):], key=key)
+
+    def url(self, keys):
+        """Returns the URL requesting the records of the keys"""
+        if self.batch_size == 1:
+            return self.key_url(keys[0])
+        ids = [key[len(self.prefix):] for key in keys]
+        return self.template.format(id=ids[0], ids=','.join(ids), key=keys[0])
+
+    def split(self, keys, content):
+        """Splits the response to the request of the keys into the record of each key. A
+        JSON response to a batch is a list with the document of each key in order"""
+        if self.response == 'bibtex':
+            return Provider.split(self, keys, content)
+        documents = json.loads(content)
+        records = {}
+        for key, document in zip(keys, documents if self.batch_size > 1 else [documents]):
+            for name in filter(None, self.field.split('.')):
+                document = document.get(name) if isinstance(document, dict) else None
+            if isinstance(document, str):
+                records[key] = document
+        return records
+
+class ResponseParser():
+    """Receives a response in chunks as they arrive, and splits it into the record of each
+    key at the end"""
+    def __init__(self, provider, keys):
+        self.provider = provider
+        self.keys = keys
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.chunks = []
+        self.size = 0
+        self.seconds = 0
+
+    def feed(self, data):
+        """Receives the next chunk of the response"""
+        start = time.perf_counter()
+        self.size += len(data)
+        self.receive(self.decoder.decode(data))
+        self.seconds += time.perf_counter() - start
+
+    def close(self):
+        """Returns the records of the keys"""
+        start = time.perf_counter()
+        self.receive(self.decoder.decode(b'', True))
+        records = self.records()
+        self.seconds += time.perf_counter() - start
+        return records
+
+    def receive(self, text):
+        """Receives the next decoded part of the response"""
+        self.chunks.append(text)
+
+    def records(self):
+        """Returns the records of the keys from the whole response"""
+        return self.provider.split(self.keys, ''.join(self.chunks))
+
+class ArxivPageParser(ResponseParser):
+    """Extracts the BibTeX record from an arXiv abstract page while it arrives, so that the
+    page is never held in memory as a whole"""
+    def __init__(self, provider, keys):
+        ResponseParser.__init__(self, provider, keys)
+        self.parser = MyHTMLParser()
+
+    def receive(self, text):
+        """Receives the next decoded part of the page"""
+        self.parser.feed(text)
+
+    def records(self):
+        """Returns the BibTeX record of the key. Raises ValueError if the page has no arXiv
+        identifier, such as a page asking to slow down"""
+        self.parser.close()
+        if 'eprint' not in self.parser.item.field:
+            raise ValueError(f'the arXiv page of {self.keys[0]} has no record')
+        return {self.keys[0]: self.parser.item.dump(self.keys[0])}
+
+class ArxivProvider(Provider):
+    """Requests single arXiv records from their abstract pages, or batches of them from the
+    arXiv API, which accepts a list of identifiers"""
+    API_URL = 'https://export.arxiv.org/api/query?id_list={ids}&max_results={count}'
+
+    def __init__(self, bibtex_file='arxiv.bib', batch_size=50):
+        Provider.__init__(self, 'arXiv', 'Arxiv:', arxiv_url, bibtex_file, 'entry')
+        self.batch_size = batch_size
+
+    def cache_name(self):
+        """Returns the name under which the records are cached, which differs between the
+        abstract pages and the API, since their records have different fields"""
+        return f'{self.name} page' if self.batch_size == 1 else f'{self.name} API'
+
+    def url(self, keys):
+        """Returns the URL requesting the records of the keys"""
+        if self.batch_size == 1:
+            return self.key_url(keys[0])
+        return self.API_URL.format(ids=quote(','.join(key[6:] for key in keys), safe=','),
+                                   count=len(keys))
+
+    def batchable(self, key):
+        """Returns whether the key is a well-formed arXiv identifier, since the API rejects a
+        whole batch for a malformed one"""
+        return ARXIV_KEY_ID_RE.fullmatch(key[6:]) is not None
+
+    def split(self, keys, content):
+        """Splits the response to the request of the keys into the record of each key"""
+        if self.batch_size == 1:
+            return Provider.split(self, keys, content)
+        by_id = {key[6:]: key for key in keys}
+        records = {}
+        for entry in parse_atom(content).iterfind('atom:entry', AtomParser.NAMESPACES):
+            entry_id = entry.findtext('atom:id', '', AtomParser.NAMESPACES).split('/abs/', 1)[-1]
+            key = by_id.get(entry_id, by_id.get(arxiv_api_id(entry_id)))
+            if key is not None:
+                parser = AtomParser()
+                parser.add_entry(entry)
+                records[key] = parser.item.dump(key)
+        return records
+
+    def parser(self, keys):
+        """Returns the parser receiving the response to the request of the keys"""
+        if self.batch_size == 1:
+            return ArxivPageParser(self, keys)
+        return ResponseParser(self, keys)
+
+def default_providers():
+    """Returns new instances of the providers of all the bibliographies"""
+    return [ArxivProvider()] + [TemplateProvider(name, spec) for name, spec in PROVIDER_SPECS.items()]
+
+def config_providers(configuration):
+    """Returns the providers described in the "[provider NAME]" sections of the configuration"""
+    return [TemplateProvider(section[len('provider '):].strip(), dict(configuration.items(section, raw=True)))
+            for section in configuration.sections() if section.startswith('provider ')]
+
+def plugin_providers(group=PROVIDER_ENTRY_POINTS):
+    """Returns the providers of the installed plugins. An entry point of the group refers to a
+    Provider, to the specification of a TemplateProvider, or to a function returning either"""
+    import importlib.metadata  # pylint: disable=import-outside-toplevel
+    entry_points = importlib.metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=group)
+    else:
+        entry_points = entry_points.get(group, [])  # before Python 3.10
+    providers = []
+    for entry_point in entry_points:
+        try:
+            provider = entry_point.load()
+        except (ImportError, AttributeError) as error:
+            raise ValueError(f'provider plugin {entry_point.name} cannot be loaded: {error}') from error
+        if callable(provider) and not isinstance(provider, Provider):
+            provider = provider()
+        providers.append(provider if isinstance(provider, Provider) else TemplateProvider(entry_point.name, provider))
+    return providers
+
+class ProviderRegistry():
+    """The providers by name, and a single pattern compiled from their prefixes that finds
+    the provider of a citation key"""
+    def __init__(self, providers=()):
+        self.providers = {}
+        self.by_prefix = {}
+        self.pattern = re.compile('(?!)')
+        for provider in providers:
+            self.register(provider)
+
+    def register(self, provider):
+        """Adds the provider, replacing the one of the same name"""
+        old = self.providers.pop(provider.name, None)
+        if old is not None:
+            del self.by_prefix[old.prefix]
+        self.providers[provider.name] = provider
+        self.by_prefix[provider.prefix] = provider
+        # the longest prefixes come first, so that a prefix of another prefix does not win
+        self.pattern = re.compile('|'.join(re.escape(prefix) for prefix in
+                                           sorted(self.by_prefix, key=len, reverse=True)) or '(?!)')
+
+    def host_rates(self):
+        """Returns the rate limits of the providers that have their own by host"""
+        return {provider.host(): provider.rate for provider in self if provider.rate}
+
+    def classify(self, key):
+        """Returns the provider of the citation key, or None if no provider has its prefix"""
+        match = self.pattern.match(key)
+        return None if match is None else self.by_prefix[match.group()]
+
+    def __getitem__(self, name):
+        return self.providers[name]
+
+    def __iter__(self):
+        return iter(self.providers.values())
+
+class CitationKeys():
+    """The citation keys of a session: the cited keys of each bibliography, the unused ones,
+    the fetched ones, the ones that could not be fetched with the reason, and the ones that
+    the websites have no record of"""
+    def __init__(self):
+        self.cited = {}
+        self.fetched = {}
+        self.unused = set()
+        self.failed = {}
+        self.not_found = set()
+
+    def of(self, provider):
+        """Returns the cited keys of the provider"""
+        return self.cited.setdefault(provider.name, set())
+
+    def add_fetched(self, provider, key):
+        """Records that the entry of the key has been fetched from the provider"""
+        self.fetched.setdefault(provider.name, set()).add(key)
+
+    def cited_sets(self):
+        """Returns the sets of the cited keys of all the bibliographies and the unused keys"""
+        return list(self.cited.values()) + [self.unused]
+
+class ResponseCache():
+    """Stores the downloaded responses by bibliography and citation key in an SQLite file
+    until they expire, evicting the least recently used ones beyond its size limit"""
+    LOW_WATER = 0.9  # an eviction frees the cache down to this fraction of its size limit
+
+    def __init__(self, path, ttl=30 * 86400, max_size=100 * 2**20):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = None  # total size of the responses, summed up when it is first needed
+        self.lock = threading.Lock()
+        self.path = path
+        self.conn = None  # opened when the cache is first used
+
+    def connection(self):
+        """Returns the connection to the cache file, which is opened on first use"""
+        if self.conn is None:
+            import sqlite3  # pylint: disable=import-outside-toplevel
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                              'provider TEXT, key TEXT, content TEXT, size INTEGER, '
+                              'fetched REAL, accessed REAL, PRIMARY KEY (provider, key))')
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(responses)')]
+            for column in ('etag', 'modified'):
+                if column not in columns:
+                    self.conn.execute(f'ALTER TABLE responses ADD COLUMN {column} TEXT')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            self.conn.commit()
+        return self.conn
+
+    def get(self, provider, key, stale=False):
+        """Returns the cached response, or None if it is not cached or has expired"""
+        with self.lock:
+            row = self.connection().execute('SELECT content, fetched FROM responses '
+                                    'WHERE provider = ? AND key = ?', (provider, key)).fetchone()
+            if row is None or (not stale and time.time() - row[1] > self.ttl):
+                return None
+            self.conn.execute('UPDATE responses SET accessed = ? WHERE provider = ? AND key = ?',
+                              (time.time(), provider, key))
+            self.conn.commit()
+            return row[0]
+
+    def cached_keys(self, provider, keys, stale=False):
+        """Returns the keys whose responses are cached and, unless stale, have not expired,
+        without marking them as used"""
+        keys = list(keys)
+        if not keys:
+            return set()
+        oldest = 0 if stale else time.time() - self.ttl
+        found = set()
+        with self.lock:
+            self.connection()
+            for i in range(0, len(keys), 500):  # SQLite limits the number of parameters
+                chunk = keys[i:i + 500]
+                found.update(row[0] for row in self.conn.execute(
+                    'SELECT key FROM responses WHERE provider = ? AND fetched >= ? '
+                    f'AND key IN ({", ".join("?" * len(chunk))})', (provider, oldest, *chunk)))
+        return found
+
+    def validators(self, provider, key):
+        """Returns the cached response with its ETag and Last-Modified header, expired or
+        not, so that it can be requested again conditionally; or None if it is not cached"""
+        with self.lock:
+            return self.connection().execute('SELECT content, etag, modified FROM responses '
+                                     'WHERE provider = ? AND key = ?', (provider, key)).fetchone()
+
+    def put_many(self, provider, contents, etag=None, modified=None):
+        """Stores the responses of one request by key in a single transaction, and evicts the
+        least recently used ones beyond the size limit"""
+        now = time.time()
+        rows = [(provider, key, content, len(content.encode('utf-8')), now, now, etag, modified)
+                for key, content in contents.items()]
+        with self.lock:
+            self.connection()
+            if self.size is None:
+                self.size = self.total_size()
+            keys = list(contents)
+            for i in range(0, len(keys), 500):  # SQLite limits the number of parameters
+                chunk = keys[i:i + 500]
+                self.size -= self.conn.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM responses WHERE provider = ? '
+                    f'AND key IN ({", ".join("?" * len(chunk))})', (provider, *chunk)).fetchone()[0]
+            self.conn.executemany('INSERT OR REPLACE INTO responses (provider, key, content, size, '
+                                  'fetched, accessed, etag, modified) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.size += sum(row[3] for row in rows)
+            if self.size > self.max_size:
+                self.evict()
+            self.conn.commit()
+
+    def total_size(self):
+        """Returns the total size of the cached responses"""
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def evict(self):
+        """Deletes the least recently used responses until the cache takes up at most
+        LOW_WATER of its size limit. The responses are counted again first, since other
+        processes may share the cache file"""
+        self.size = self.total_size()
+        if self.size <= self.max_size:
+            return
+        rows = self.conn.execute('SELECT provider, key, size FROM responses ORDER BY accessed')
+        evicted = []
+        for provider, key, size in rows:
+            if self.size <= self.max_size * self.LOW_WATER:
+                break
+            evicted.append((provider, key))
+            self.size -= size
+        self.conn.executemany('DELETE FROM responses WHERE provider = ? AND key = ?', evicted)
+
+    def close(self):
+        """Closes the cache file, if it has been opened"""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+class Decompressor():
+    """Decodes a response body in chunks according to its Content-Encoding. A malformed
+    body raises http.client.HTTPException, so that it fails like a broken response"""
+    def __init__(self, encoding):
+        self.encoding = encoding.lower()
+        self.decompressor = None
+
+    def decompress(self, chunk):
+        """Returns the decoded data of the chunk"""
+        if self.encoding not in ('gzip', 'deflate'):
+            return chunk
+        if self.decompressor is None:
+            if self.encoding == 'gzip':
+                wbits = 16 + zlib.MAX_WBITS
+            elif len(chunk) > 1 and (chunk[0] & 0x0f) == 8 and (chunk[0] << 8 | chunk[1]) % 31 == 0:
+                wbits = zlib.MAX_WBITS
+            else:  # raw deflate without zlib header
+                wbits = -zlib.MAX_WBITS
+            self.decompressor = zlib.decompressobj(wbits)
+        try:
+            return self.decompressor.decompress(chunk)
+        except zlib.error as error:
+            raise http.client.HTTPException(f'malformed {self.encoding} response: {error}') from error
+
+    def flush(self):
+        """Returns the rest of the decoded data"""
+        try:
+            return self.decompressor.flush() if self.decompressor is not None else b''
+        except zlib.error as error:
+            raise http.client.HTTPException(f'malformed {self.encoding} response: {error}') from error
+
+class HttpClient():
+    """Keeps the connections to each host open between requests (HTTP keep-alive), sends
+    the requests through the configured proxy, and decodes compressed responses"""
+    REDIRECTS = (301, 302, 303, 307, 308)
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    NOT_FOUND_STATUSES = (404, 410)  # the website has no record for the request
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, proxies=None, timeout=30):
+        self.proxies = proxies  # looked up in the environment on the first request if None
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.retries = 3
+        self.backoff = 1.0
+        self.limiter = RateLimiter(4.0, {'arxiv.org': 1.0, 'export.arxiv.org': 1 / 3})
+
+    def proxy(self, scheme, host):
+        """Returns the proxy for the host, or None if the host is reached directly"""
+        import urllib.request  # pylint: disable=import-outside-toplevel
+        if self.proxies is None:
+            self.proxies = urllib.request.getproxies()
+        proxy = self.proxies.get(scheme)
+        return None if not proxy or urllib.request.proxy_bypass(host.split(':')[0]) else proxy
+
+    def connect(self, scheme, host):
+        """Returns a new connection to the host, or to the proxy for the host"""
+        proxy = self.proxy(scheme, host)
+        if proxy is None:
+            if scheme == 'https':
+                return http.client.HTTPSConnection(host, timeout=self.timeout)
+            return http.client.HTTPConnection(host, timeout=self.timeout)
+        proxy_host = urlsplit(proxy if '://' in proxy else f'http://{proxy}').netloc
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(proxy_host, timeout=self.timeout)
+            conn.set_tunnel(host)
+            return conn
+        return http.client.HTTPConnection(proxy_host, timeout=self.timeout)
+
+    def acquire(self, scheme, host):
+        """Returns an idle connection to the host, or a new one if there is none"""
+        with self.lock:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+        return self.connect(scheme, host), False
+
+    def release(self, scheme, host, conn):
+        """Keeps the connection to the host open for the next request"""
+        with self.lock:
+            self.idle.setdefault((scheme, host), []).append(conn)
+
+    def request(self, url, headers=None, consumer=None):
+        """Sends a GET request and returns its status and headers. The decoded body of a
+        successful response is fed to the consumer in chunks as it arrives"""
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        if parts.scheme == 'http' and self.proxy('http', parts.netloc):
+            path = url  # plain HTTP proxies expect the full URL
+        headers = dict(headers or {}, **{'Accept-Encoding': 'gzip, deflate',
+                                         'User-Agent': 'get_bibtex'})
+        conn, reused = self.acquire(parts.scheme, parts.netloc)
+        try:
+            try:
+                conn.request('GET', path, headers=headers)
+                res = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # the server has closed the idle connection meanwhile; try once on a new one
+                conn.close()
+                conn = self.connect(parts.scheme, parts.netloc)
+                conn.request('GET', path, headers=headers)
+                res = conn.getresponse()
+            decompressor = Decompressor(res.getheader('Content-Encoding', ''))
+            success = 200 <= res.status < 300 and consumer is not None
+            while True:
+                chunk = res.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                if success:
+                    consumer.feed(decompressor.decompress(chunk))
+            if success:
+                consumer.feed(decompressor.flush())
+        except BaseException:
+            conn.close()  # a connection in an unknown state is never reused
+            raise
+        if res.will_close:
+            conn.close()
+        else:
+            self.release(parts.scheme, parts.netloc, conn)
+        return res.status, res.headers
+
+    def get(self, url, headers=None, consumer=None):
+        """Sends a GET request, following redirects, and returns the response status and
+        headers, feeding the decoded body to the consumer. Raises HTTPError for error
+        responses"""
+        for _ in range(5):
+            status, res_headers = self.request(url, headers, consumer)
+            if status in self.REDIRECTS and res_headers.get('Location'):
+                url = urljoin(url, res_headers['Location'])
+                continue
+            if status >= 400:
+                raise HTTPError(url, status, http.client.responses.get(status, ''), res_headers, None)
+            return status, res_headers
+        raise HTTPError(url, status, 'Too many redirects', res_headers, None)
+
+    def retry_delay(self, attempt, headers=None):
+        """Returns the seconds to wait before the next attempt: the Retry-After header of
+        the response if it has one, or else an exponential backoff with random jitter"""
+        retry_after = headers.get('Retry-After') if headers is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), 300)
+            except ValueError:
+                try:
+                    return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0), 300)
+                except (TypeError, ValueError):
+                    pass
+        return self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    def fetch(self, url, headers=None, make_consumer=None, stats=None):
+        """Sends a GET request within the rate limit of the host, retrying it on timeouts,
+        connection errors and server errors. Returns the status, headers and consumer"""
+        host = urlsplit(url).netloc
+        stats = stats or MetricsScope(Metrics(), host)
+        attempt = 0
+        while True:
+            self.limiter.acquire(host)
+            stats.count('requests')
+            if attempt:
+                stats.count('retries')
+            consumer = make_consumer() if make_consumer is not None else None
+            start = time.perf_counter()
+            try:
+                response = self.get(url, headers, consumer) + (consumer,)
+                stats.observe(time.perf_counter() - start)
+                return response
+            except HTTPError as error:
+                stats.observe(time.perf_counter() - start)
+                if error.code not in self.RETRY_STATUSES or attempt >= self.retries:
+                    raise
+                delay = self.retry_delay(attempt, error.headers)
+            except (OSError, http.client.HTTPException):
+                stats.observe(time.perf_counter() - start)
+                if attempt >= self.retries:
+                    raise
+                delay = self.retry_delay(attempt)
+            attempt += 1
+            time.sleep(delay)
+
+    def close(self):
+        """Closes all of the idle connections"""
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+def is_outage(error):
+    """Returns whether the error of a request suggests that the website is down or
+    overloaded (a timeout, a connection error, 429 or a server error), rather than that
+    something is wrong with the request or its response"""
+    if isinstance(error, HTTPError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, (OSError, http.client.HTTPException))
+
+def batch_requests(provider, keys):
+    """Groups the keys into as few (provider, keys, URL) requests as the provider allows, in
+    key order. A key that the provider cannot request in a batch gets a request of its own"""
+    size = max(provider.batch_size, 1)
+    requests, batch = [], []
+    for key in sorted(keys):
+        if not provider.batchable(key):
+            requests.append((provider, (key,), provider.url([key])))
+            continue
+        batch.append(key)
+        if len(batch) == size:
+            requests.append((provider, tuple(batch), provider.url(batch)))
+            batch = []
+    if batch:
+        requests.append((provider, tuple(batch), provider.url(batch)))
+    return requests
+
+class FetchPlan():
+    """The cited keys of each bibliography that are in the BibTeX files, in the response
+    cache, to be downloaded or unavailable offline, worked out before any download"""
+    def __init__(self):
+        self.steps = {}
+
+    def add(self, provider, present, cached, missing, offline=False):
+        """Adds the cited keys of the provider that are present in its BibTeX file, those that
+        are cached and the missing ones, which are downloaded unless we are offline"""
+        self.steps[provider.name] = {
+            'present': sorted(present), 'cached': sorted(cached),
+            'fetch': [] if offline else sorted(missing),
+            'unavailable': sorted(missing) if offline else [],
+            'requests': 0 if offline else len(batch_requests(provider, missing))}
+
+    def requests(self):
+        """Returns the number of requests that the fetch stage will send"""
+        return sum(step['requests'] for step in self.steps.values())
+
+    def as_dict(self):
+        """Returns the plan as a dictionary that can be written as JSON"""
+        return {'bibliographies': self.steps, 'requests': self.requests()}
+
+    def report(self):
+        """Prints the number of keys of each kind and the keys that will be downloaded"""
+        print('\nPlan (nothing has been downloaded):')
+        for name, step in self.steps.items():
+            print(f'{name}: {len(step["present"])} in the BibTeX file, {len(step["cached"])} cached, '
+                  f'{len(step["fetch"])} to fetch in {step["requests"]} request(s)'
+                  + (f', {len(step["unavailable"])} not cached while offline' if step['unavailable'] else ''))
+            for key in step['fetch']:
+                print(f'  {key}')
+        print(f'{self.requests()} request(s) in total.')
+
+class FetchPipeline():
+    """Fetches the records of a FetchPlan with fetch workers and parser threads, and hands
+    them on in key order for each bibliography from the calling thread"""
+    WINDOW = 4  # requests of a bibliography that may be fetched ahead of the writer
+    PARSERS = 2  # threads splitting the responses into records
+    QUEUE_SIZE = 16  # responses waiting to be parsed, and records waiting to be written
+
+    def __init__(self, fetching_session, plan, offline=False, host_workers=2):
+        self.session = fetching_session
+        self.offline = offline
+        self.streams = collections.deque()
+        for provider in fetching_session.providers:
+            step = plan.steps[provider.name]
+            requests = batch_requests(provider, step['fetch'])
+            self.streams.append({
+                'provider': provider, 'requests': requests, 'planned': len(requests),
+                'keys': sorted(step['fetch'] + step['cached'] + step['unavailable']),
+                'cached': set(step['cached']), 'cursor': 0, 'low': 0, 'done': {},
+                'index': {key: index for index, (_, keys, _) in enumerate(requests) for key in keys},
+                'pending': collections.deque(range(len(requests)))})
+        self.condition = threading.Condition()
+        self.finished = False
+        self.queues = (queue.Queue(self.QUEUE_SIZE), queue.Queue(self.QUEUE_SIZE))
+        self.host_limits = collections.defaultdict(lambda: threading.BoundedSemaphore(host_workers))
+
+    def next_request(self):
+        """Waits until a request may be started, and takes it together with a slot of its
+        host. Returns its stream and index, or None once all the records have been written"""
+        with self.condition:
+            while not self.finished:
+                for _ in range(len(self.streams)):
+                    stream = self.streams[0]
+                    self.streams.rotate(-1)
+                    if not stream['pending']:
+                        continue
+                    index = stream['pending'][0]
+                    # the requests of evicted cache entries are always in the window
+                    if stream['low'] + self.WINDOW <= index < stream['planned']:
+                        continue
+                    if self.host_limits[urlsplit(stream['requests'][index][2]).netloc].acquire(False):
+                        return stream, stream['pending'].popleft()
+                self.condition.wait()
+        return None
+
+    def download(self, request):
+        """Downloads the response to a (provider, keys, URL) request, parsing it while it
+        arrives; a single expired record is requested conditionally"""
+        provider, keys, url = request
+        cached = None
+        headers = dict(provider.headers)
+        if self.session.cache is not None and len(keys) == 1:
+            cached = self.session.cache.validators(provider.cache_name(), keys[0])
+            if cached is not None and cached[1]:
+                headers['If-None-Match'] = cached[1]
+            if cached is not None and cached[2]:
+                headers['If-Modified-Since'] = cached[2]
+
+        stats = self.session.metrics.scope(provider.name)
+        status, res_headers, parser = self.session.client.fetch(url, headers, lambda: provider.parser(keys), stats)
+        return status, res_headers, parser, cached
+
+    def parse(self, request, response):
+        """Splits the downloaded response to a (provider, keys, URL) request into the record
+        of each key"""
+        provider, keys, _ = request
+        status, _, parser, cached = response
+        stats = self.session.metrics.scope(provider.name)
+        if status == 304 and cached is not None:
+            stats.count('not_modified')
+            return {keys[0]: cached[0]}
+        records = parser.close()
+        stats.count('bytes', parser.size)
+        stats.count('parse_seconds', parser.seconds)
+        return records
+
+    def fail(self, request, error):
+        """Records the keys of a (provider, keys, URL) request as failed because of the error.
+        Only an outage of the website counts towards its circuit breaker"""
+        provider, keys, _ = request
+        if is_outage(error):
+            provider.breaker.failure()
+        self.session.metrics.count(provider.name, 'failures', len(keys))
+        self.session.keys.failed.update((key, str(error) or type(error).__name__) for key in keys)
+
+    def fetch_worker(self):
+        """Downloads the requests and queues the responses for the parsers. An unexpected
+        error is handed on to the writer"""
+        try:
+            self.fetch_requests()
+        except BaseException as error:
+            self.queues[1].put(error)
+            raise
+
+    def fetch_requests(self):
+        """Downloads requests until all the records have been written"""
+        while True:
+            task = self.next_request()
+            if task is None:
+                return
+            stream, index = task
+            request = stream['requests'][index]
+            response = None
+            try:
+                if request[0].breaker.allow():
+                    response = self.download(request)
                 else:
-                    print(f'(not adding {key} to {name} BibTeX file, it is already there.)')
-
-def open_bibtex_file_diff_key(name_bibtex_file, name_bibtex_file_content, fetched_name_keys, unknown_name_key, name):
-    """Opens the BibTeX file for the bibliography with the different LaTeX citation key and
-    writes it to our BibTeX file if it is not already there"""
-    with open(name_bibtex_file, 'a', encoding="utf8") as file:
-        for match in re.finditer(compile_bibtex_items(), name_bibtex_file_content):
-            for bibtex_item in match.groups():
-                key = re.match(compile_bibtex_item_key(), bibtex_item).group(1)
-                if key not in fetched_name_keys | known_keys:
-                    file.write(f'@article{{{unknown_name_key}, crossref = {{{key}}}}}')
-                    file.write('\n\n')
-                    file.write(bibtex_item)
-                    file.write('\n\n')
-                    fetched_name_keys.add(key)
+                    self.session.keys.failed.update((key, f'{request[0].name} is not responding')
+                                                    for key in request[1])
+            except HTTPError as error:
+                if len(request[1]) > 1 and 400 <= error.code < 500 and error.code != 429:
+                    # the batch is asked for in halves, so that a bad key only fails itself
+                    self.session.metrics.count(request[0].name, 'split_requests')
+                    self.queue_requests(stream, request[1])
+                    continue  # nothing is written for the batch itself
+                if error.code in HttpClient.NOT_FOUND_STATUSES:
+                    # the website has answered, the records are written as not found
+                    request[0].breaker.success()
+                    self.session.metrics.count(request[0].name, 'not_found', len(request[1]))
                 else:
-                    print(f'(not adding {key} to {name} BibTeX file, it is already there.)')
-
-def open_bibtex_file_parser(name_bibtex_file, name_bibtex_file_content):
-    """Opens the BibTeX file for the bibliography that uses HTML Parser and
-    writes it to our BibTeX file if it is not already there"""
-    with open(name_bibtex_file, 'a', encoding="utf8") as file:
-        file.write(name_bibtex_file_content.item.dump())
-    with open(name_bibtex_file, 'r', encoding="utf8") as file:
-        lines = dict.fromkeys(file.readlines())
-    with open(name_bibtex_file, 'w', encoding="utf8") as file:
-        file.writelines(lines)
-    name_bibtex_file_content.close()
-
-def open_arxiv_url():
-    """Opens arXiv BibTeX file from its website"""
-    for unknown_arxiv_key in check_missing_keys(arxiv_bibtex_file, arxiv_keys, 'arXiv', ):
-        print (f'{unknown_arxiv_key}')
-
-        arxiv_url = f'https://arxiv.org/abs/{unknown_arxiv_key[6:]}'
-
-        with req.urlopen(arxiv_url) as res:
-            arxiv_bibtex_file_content = MyHTMLParser()
-            arxiv_bibtex_file_content.feed(res.read().decode('utf-8'))
-            res.close()
-
-            open_bibtex_file_parser(arxiv_bibtex_file, arxiv_bibtex_file_content)
-
-def open_base_url():
-    """Opens BASE BibTeX file from its website"""
-    for unknown_base_key in check_missing_keys(base_bibtex_file, base_keys, 'BASE'):
-        print (f'{unknown_base_key}')
-
-        base_url = f'https://www.base-search.net/Record/{unknown_base_key[5:]}/Export?style[]=BibTeX'
-
-        with req.urlopen(base_url) as res:
-            base_bibtex_file_content = res.read().decode('utf-8')
-            open_bibtex_file_diff_key(base_bibtex_file, base_bibtex_file_content, fetched_base_keys, unknown_base_key,'BASE')
-
-def open_cogprints_url():
-    """Opens Cogprints BibTeX file from its website"""
-    for unknown_cogprints_key in check_missing_keys(cogprints_bibtex_file, cogprints_keys, 'Cogprints'):
-        print (f'{unknown_cogprints_key}')
-
-        cogprints_url = f'https://web-archive.southampton.ac.uk/cogprints.org/cgi/export/eprint/{unknown_cogprints_key[10:]}.bib.html'
-
-        with req.urlopen(cogprints_url) as res:
-            cogprints_bibtex_file_content = res.read().decode('utf-8')
-            open_bibtex_file_diff_key(cogprints_bibtex_file, cogprints_bibtex_file_content, fetched_cogprints_keys, unknown_cogprints_key, 'Cogprints')
-
-def open_dblp_url():
-    """Opens DBLP BibTeX file from its website"""
-    for unknown_dblp_key in check_missing_keys(dblp_bibtex_file, dblp_keys, 'DBLP'):
-        print (f'{unknown_dblp_key}')
-
-        dblp_url = f'https://dblp.org/rec/{unknown_dblp_key[5:]}.bib'
-
-        with req.urlopen(dblp_url) as res:
-            dblp_bibtex_file_content = res.read().decode('utf-8')
-            open_bibtex_file_same_key(dblp_bibtex_file, dblp_bibtex_file_content, fetched_dblp_keys, 'DBLP')
-
-def open_jstor_url():
-    """Opens JSTOR BibTeX file from its website"""
-    for unknown_jstor_key in check_missing_keys(jstor_bibtex_file, jstor_keys, 'JSTOR'):
-        print (f'{unknown_jstor_key}')
-
-        jstor_url = f'https://www.jstor.org/citation/text/{unknown_jstor_key[6:]}'
-
-        with req.urlopen(jstor_url) as res:
-            jstor_bibtex_file_content = res.read().decode('utf-8')
-            open_bibtex_file_diff_key(jstor_bibtex_file, jstor_bibtex_file_content, fetched_jstor_keys, unknown_jstor_key, 'JSTOR')
-
-def open_microsoft_url():
-    """Opens Microsoft Research BibTeX file from its website"""
-    for unknown_microsoft_key in check_missing_keys(microsoft_bibtex_file, microsoft_keys, 'Microsoft Research'):
-        print (f'{unknown_microsoft_key}')
-
-        microsoft_url = f'https://www.microsoft.com/en-us/research/publication/{unknown_microsoft_key[10:]}/bibtex/'
-
-        with req.urlopen(microsoft_url) as res:
-            microsoft_bibtex_file_content = res.read().decode('utf-8')
-            open_bibtex_file_diff_key(microsoft_bibtex_file, microsoft_bibtex_file_content, fetched_microsoft_keys, unknown_microsoft_key, 'Microsoft Research')
-
-def open_springer_url():
-    """Opens SpringerLink BibTeX file from its website"""
-    for unknown_springer_key in check_missing_keys(springer_bibtex_file, springer_keys, 'SpringerLink'):
-        print (f'{unknown_springer_key}')
-
-        springer_url = f'https://citation-needed.springer.com/v2/references/10.1007/{unknown_springer_key[9:]}'
-
-        with req.urlopen(springer_url) as res:
-            springer_bibtex_file_content = res.read().decode('utf-8')
-            open_bibtex_file_diff_key(springer_bibtex_file, springer_bibtex_file_content, fetched_springer_keys, unknown_springer_key, 'SpringerLink')
-
-def open_url():
-    """Calls on the previous functions of opening the BibTeX files from their website"""
-    open_arxiv_url()
-    open_base_url()
-    open_cogprints_url()
-    open_dblp_url()
-    open_jstor_url()
-    open_microsoft_url()
-    open_springer_url()
+                    self.fail(request, error)
+            except (OSError, http.client.HTTPException, ValueError) as error:
+                self.fail(request, error)  # pages are parsed while they arrive
+            finally:
+                with self.condition:
+                    self.host_limits[urlsplit(request[2]).netloc].release()
+                    self.condition.notify()
+            self.queues[0].put((stream, index, response))
+
+    def parse_worker(self):
+        """Splits the queued responses into records and queues them for the writer. An
+        unexpected error is handed on to the writer"""
+        try:
+            self.parse_responses()
+        except BaseException as error:
+            self.queues[1].put(error)
+            raise
+
+    def parse_responses(self):
+        """Parses responses until the fetch workers have stopped"""
+        while True:
+            item = self.queues[0].get()
+            if item is None:
+                return
+            stream, index, response = item
+            request = stream['requests'][index]
+            records = {}
+            if response is not None:
+                try:
+                    records = self.parse(request, response)
+                    request[0].breaker.success()
+                except ValueError as error:
+                    self.fail(request, error)
+            self.queues[1].put((stream, index, records, None if response is None else response[1]))
+
+    def store(self, stream, index, records, headers):
+        """Keeps the records of a request until they are written, and stores the ones with a
+        BibTeX entry in the response cache, so that an error page is asked for again"""
+        provider = stream['provider']
+        valid = {key: record for key, record in records.items() if provider.bibtex_entries(key, record)}
+        if self.session.cache is not None and valid:
+            self.session.cache.put_many(provider.cache_name(), valid,
+                                        headers.get('ETag'), headers.get('Last-Modified'))
+        stream['done'][index] = records
+
+    def read_cached(self, stream, key):
+        """Returns the cached record of the key, or None if it has been evicted since the
+        fetch was planned; unless we are offline, a request for it is then queued in front of
+        the others"""
+        provider = stream['provider']
+        record = self.session.cache.get(provider.cache_name(), key, stale=True)
+        if record is not None:
+            self.session.metrics.count(provider.name, 'cache_hits')
+            return record
+        if self.offline:
+            print(f'(not fetching {key}, it is not in the cache and we are offline.)')
+            return None
+        self.session.metrics.count(provider.name, 'cache_misses')
+        self.queue_requests(stream, [key])
+        return None
+
+    def queue_requests(self, stream, keys):
+        """Queues new requests for the keys of the stream in front of the others, in two
+        halves if there are several keys"""
+        requests = batch_requests(stream['provider'], keys[:(len(keys) + 1) // 2])
+        requests += batch_requests(stream['provider'], keys[(len(keys) + 1) // 2:])
+        with self.condition:
+            first = len(stream['requests'])
+            for index, request in enumerate(requests, first):
+                stream['index'].update(dict.fromkeys(request[1], index))
+            stream['requests'].extend(requests)
+            stream['pending'].extendleft(reversed(range(first, first + len(requests))))
+            self.condition.notify(len(requests))
+
+    def advance(self, stream, write):
+        """Writes the records of the keys of the stream in order, as far as they are known,
+        with write(provider, key, record), where the record is None if it was not found.
+        Returns whether all of the keys have been written"""
+        provider, keys = stream['provider'], stream['keys']
+        while stream['cursor'] < len(keys):
+            key = keys[stream['cursor']]
+            index = stream['index'].get(key)
+            if index is None and key in stream['cached']:
+                record = self.read_cached(stream, key)
+                if record is None and not self.offline:
+                    return False  # waits for the request of the evicted key
+                write(provider, key, record)
+            elif index is None:
+                write(provider, key, None)
+            else:
+                if stream['low'] < index < stream['planned']:
+                    with self.condition:
+                        self.condition.notify(index - stream['low'])
+                        stream['low'] = index
+                if index not in stream['done']:
+                    return False
+                record = stream['done'][index].pop(key, None)
+                if record is None and key not in self.session.keys.failed:
+                    self.session.keys.not_found.add(key)
+                write(provider, key, record)
+                if key == stream['requests'][index][1][-1]:
+                    del stream['done'][index]
+            stream['cursor'] += 1
+        return True
+
+    def run(self, write, workers=8):
+        """Fetches and writes all of the records with write(provider, key, record), using
+        the given number of fetch workers"""
+        threads = [threading.Thread(target=self.fetch_worker, daemon=True) for _ in range(workers)]
+        threads += [threading.Thread(target=self.parse_worker, daemon=True) for _ in range(self.PARSERS)]
+        streams = tuple(self.streams)
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                with self.session.metrics.phase('fetch_and_write.writer'):
+                    complete = [self.advance(stream, write) for stream in streams]
+                if all(complete):
+                    break
+                item = self.queues[1].get()
+                if isinstance(item, BaseException):
+                    raise item
+                with self.session.metrics.phase('fetch_and_write.writer'):
+                    self.store(*item)
+        except BaseException:
+            self.stop(threads)
+            raise
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+        for _ in range(self.PARSERS):
+            self.queues[0].put(None)
+        for thread in threads:
+            thread.join()
+
+    def stop(self, threads):
+        """Stops the stages after an error: the fetch workers once they have finished their
+        current request, and then the parsers. The responses and records that are still
+        coming are discarded meanwhile, so that no stage stays blocked on a full queue"""
+        fetchers, parsers = threads[:-self.PARSERS], threads[-self.PARSERS:]
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+        while any(thread.is_alive() for thread in threads):
+            if not any(thread.is_alive() for thread in fetchers):
+                with contextlib.suppress(queue.Full):
+                    self.queues[0].put_nowait(None)
+            if not any(thread.is_alive() for thread in parsers):
+                with contextlib.suppress(queue.Empty):
+                    self.queues[0].get_nowait()
+            with contextlib.suppress(queue.Empty):
+                self.queues[1].get(timeout=0.05)
+
+class PollingWatcher():
+    """Detects changes of the .tex files by comparing their modification times and sizes"""
+    def __init__(self, tex_files, interval=1.0):
+        self.tex_files = tex_files
+        self.interval = interval
+        self.stats = self.snapshot()
+
+    def snapshot(self):
+        """Returns the modification time and size of every .tex file"""
+        stats = {}
+        for path in self.tex_files.walk():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats[path] = (stat.st_mtime, stat.st_size)
+        return stats
+
+    def wait(self, timeout=None):
+        """Waits until a .tex file has changed or the timeout has passed, and returns the
+        paths of the changed files"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+            if delay > 0:
+                time.sleep(delay)
+            stats = self.snapshot()
+            changed = {path for path in stats.keys() | self.stats.keys()
+                       if stats.get(path) != self.stats.get(path)}
+            self.stats = stats
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        """Stops watching"""
+
+class InotifyWatcher():
+    """Detects changes of the .tex files through the inotify events of the Linux kernel"""
+    IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x08, 0x40, 0x80
+    IN_CREATE, IN_DELETE, IN_ISDIR = 0x100, 0x200, 0x40000000
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, tex_files):
+        self.tex_files = tex_files
+        import ctypes  # pylint: disable=import-outside-toplevel
+        import ctypes.util  # pylint: disable=import-outside-toplevel
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+        for dirpath, dirnames, _ in os.walk(tex_files.directory):
+            dirnames[:] = [d for d in dirnames if d not in tex_files.exclude_directories]
+            self.add_directory(dirpath)
+
+    def add_directory(self, path):
+        """Starts watching the directory"""
+        mask = (self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO |
+                self.IN_CREATE | self.IN_DELETE)
+        descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if descriptor >= 0:
+            self.directories[descriptor] = path
+
+    def wait(self, timeout=None):
+        """Waits until a .tex file has changed or the timeout has passed, and returns the
+        paths of the changed files"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # wakes up every second so that Ctrl+C is handled even while waiting
+            delay = 1.0 if deadline is None else min(1.0, deadline - time.monotonic())
+            if delay > 0 and select.select([self.fd], [], [], delay)[0]:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            path = os.path.join(self.directories.get(descriptor, ''), name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and name not in self.tex_files.exclude_directories:
+                    self.add_directory(path)
+            elif self.tex_files.is_tex_file(name):
+                changed.add(path)
+        return changed
+
+    def close(self):
+        """Stops watching"""
+        os.close(self.fd)
+
+def make_watcher(tex_files, poll_interval=None):
+    """Returns an inotify watcher if the system supports it and no polling interval is
+    given, and a polling watcher otherwise"""
+    if poll_interval is None and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(tex_files)
+        except (OSError, AttributeError, TypeError):
+            print('\n(inotify is not available, polling for changes instead.)')
+    return PollingWatcher(tex_files, poll_interval or 1.0)
+
+def wait_for_changes(watcher, debounce):
+    """Waits for changes of the .tex files and returns them once no further change has
+    happened for the debounce time, so that saving several files triggers one round"""
+    changed = set()
+    while not changed:
+        changed = watcher.wait()
+    while True:
+        more = watcher.wait(debounce)
+        if not more:
+            return changed
+        changed |= more
+
+class BibSession():
+    """Keeps the BibTeX files of a LaTeX project in sync with its citations. All of the state
+    of a run lives in the session, so that several projects can be processed concurrently
+    in one process, each with its own session"""
+    def __init__(self, tex_files=None, providers=None, database=None, cache=None, client=None):
+        self.tex = TexFiles() if tex_files is None else tex_files
+        self.providers = ProviderRegistry(default_providers()) if providers is None else providers
+        self.database = BibDatabase() if database is None else database
+        self.cache = cache
+        self.client = HttpClient() if client is None else client
+        self.metrics = Metrics()
+        self.keys = CitationKeys()
+        for host, rate in self.providers.host_rates().items():
+            self.client.limiter.host_rates.setdefault(host, rate)
+
+    def read_existing_files(self, names_bibtex_files):
+        """Reads the existing BibTeX files, in parallel processes if they are large enough, or
+        creates new ones for those that are not found"""
+        names_bibtex_files = list(dict.fromkeys(names_bibtex_files))
+        for name_bibtex_file, exists in zip(names_bibtex_files, self.database.read_all(
+                names_bibtex_files, self.tex.processes)):
+            if exists:
+                print(f'\nReading existing BibTeX file {name_bibtex_file}')
+            else:
+                print(f'\nBibTeX file {name_bibtex_file} not found, will try to create it.')
+
+    def read_all_existing_files(self):
+        """Compiles and reads all of the existing bibliography BibTex files"""
+        self.read_existing_files([provider.bibtex_file for provider in self.providers])
+
+        print('\nThe following {name} keys have been found in your BibTeX files:')
+        for key in self.database:
+            print (f'{key}')
+
+    def find_all_keys(self):
+        """Calls on the previous functions of finding the keys of all the bibliographies"""
+        for provider in self.providers:
+            find_keys(provider.name, self.keys.of(provider))
+        find_keys('unused', self.keys.unused)
+
+    def add_keys(self, keys):
+        """Adds the citation keys to the cited keys of their bibliographies, or to the unused
+        keys"""
+        for key in keys:
+            provider = self.providers.classify(key)
+            if provider is None:
+                self.keys.unused.add(key)
+            else:
+                self.keys.of(provider).add(key)
+
+    def read_latex(self):
+        """Reads the LateX documents and adds the corresponding keys"""
+        print('\nReading your LaTeX documents:')
+
+        with self.metrics.phase('read_latex.scan'):
+            paths = self.tex.walk()
+        with self.metrics.phase('read_latex.match'):
+            keys = self.tex.index.update(paths, self.tex.processes)
+        for path, path_keys in zip(paths, keys):
+            print (f'{os.path.basename(path)}')
+            self.add_keys(path_keys)
+        self.tex.index.save()
+
+        self.find_all_keys()
+
+    def write_record(self, provider, cited_key, record):
+        """Writes the downloaded record of the cited key to the BibTeX file of the provider,
+        leaving out the entries that are already there. A record without BibTeX entries, such
+        as an error page, is recorded as failed"""
+        entries = provider.bibtex_entries(cited_key, record)
+        if not entries:
+            self.keys.failed[cited_key] = f'the {provider.name} record has no BibTeX entry'
+            self.metrics.count(provider.name, 'failures')
+            return
+        for key, bibtex_item in entries:
+            if provider.writer == 'crossref' and key not in self.database:
+                self.database.add(provider.bibtex_file, cited_key,
+                                  f'@article{{{cited_key}, crossref = {{{key}}}}}\n\n')
+            if self.database.add(provider.bibtex_file, key, f'{bibtex_item}\n\n'):
+                self.keys.add_fetched(provider, key)
+                self.metrics.count(provider.name, 'entries_written')
+            else:
+                print(f'(not adding {key} to {provider.name} BibTeX file, it is already there.)')
+
+    def report_missing(self):
+        """Prints which of the bibliographies have missing keys"""
+        for provider in self.providers:
+            check_missing_keys(provider.bibtex_file, self.keys.of(provider), provider.name, self.database)
+
+    def write_fetched(self, provider, key, record):
+        """Adds the record of a missing key, or None if it was not found, to the BibTeX file
+        of the provider as soon as it has been fetched"""
+        print(f'{key}')
+        if record is None:
+            print(f'(no {key} record was found.)')
+        else:
+            self.write_record(provider, key, record)
+
+    def plan(self, offline=False):
+        """Works out which of the cited keys of all the bibliographies are missing in the
+        BibTeX files, and which of those have to be downloaded because their records are
+        not cached, without any network I/O. Returns the FetchPlan"""
+        plan = FetchPlan()
+        for provider in self.providers:
+            cited = self.keys.of(provider)
+            missing = {key for key in cited if key not in self.database}
+            cached = set() if self.cache is None else self.cache.cached_keys(provider.cache_name(), missing,
+                                                                           stale=offline)
+            plan.add(provider, cited - missing, cached, missing - cached, offline)
+        return plan
+
+    def fetch_all(self, workers=8, host_workers=2, offline=False, plan=None, write=None):
+        """Downloads the records of the missing keys of the plan, and hands them to
+        write(provider, key, record) in key order, or returns them by key without write"""
+        if plan is None:
+            plan = self.plan(offline)
+        records = {}
+        self.keys.failed.clear()
+        self.keys.not_found.clear()
+        for provider in self.providers:
+            step = plan.steps[provider.name]
+            for key in step['unavailable']:
+                print(f'(not fetching {key}, it is not in the cache and we are offline.)')
+            if self.cache is not None:
+                self.metrics.count(provider.name, 'cache_misses', len(step['fetch']))
+        def keep(_, key, record):
+            if record is not None:
+                records[key] = record
+
+        FetchPipeline(self, plan, offline, host_workers).run(write or keep, workers)
+        return records
+
+    def report_failed_keys(self):
+        """Prints the keys that could not be fetched and the ones that were not found"""
+        if self.keys.failed:
+            print('\nThe following keys could not be fetched:')
+            for key in sorted(self.keys.failed):
+                print(f'{key} ({self.keys.failed[key]})')
+        if self.keys.not_found:
+            print('\nThe following keys were not found:')
+            for key in sorted(self.keys.not_found):
+                print(key)
+
+    def open_url(self, workers=8, host_workers=2, offline=False):
+        """Downloads all of the missing BibTeX records concurrently, adding each to its BibTeX
+        file as soon as it is known, then writes the BibTeX files"""
+        self.report_missing()
+        try:
+            with self.metrics.phase('fetch_and_write'):
+                self.fetch_all(workers, host_workers, offline, write=self.write_fetched)
+        finally:
+            # the records fetched before an error are kept
+            with self.metrics.phase('write'):
+                self.database.flush()
+        self.report_failed_keys()
+
+    def prepare(self):
+        """Reads the BibTeX files and the LaTeX documents, so that the fetch stage can be
+        planned"""
+        with self.metrics.phase('read_all_existing_files'):
+            self.read_all_existing_files()
+        with self.metrics.phase('read_latex'):
+            self.read_latex()
+
+    def run(self, workers=8, host_workers=2, offline=False):
+        """Reads the BibTeX files and the LaTeX documents, and fetches the missing records.
+        Returns the keys that could not be fetched, with the reason"""
+        self.prepare()
+        self.open_url(workers, host_workers, offline)
+        return self.keys.failed
+
+    def watch(self, fetch, debounce=0.5, poll_interval=None):
+        """Keeps the BibTeX files in sync with the .tex files until interrupted. After each
+        batch of changes, only the keys that were not cited before are fetched"""
+        cited = set().union(*self.keys.cited_sets()) - self.keys.failed.keys()  # tries the failed keys again
+        watcher = make_watcher(self.tex, poll_interval)
+        print(f'\nWatching {self.tex.directory} for changes of your LaTeX documents (Ctrl+C to stop).')
+        try:
+            while True:
+                changed = wait_for_changes(watcher, debounce)
+                print(f'\n{len(changed)} LaTeX document(s) changed.')
+                for name_keys in self.keys.cited_sets():
+                    name_keys.clear()
+                self.read_all_existing_files()
+                self.read_latex()
+                for name_keys in self.keys.cited_sets():
+                    name_keys -= cited
+                    cited |= name_keys
+                fetch()
+                cited -= self.keys.failed.keys()  # tries them again in the next round
+        except KeyboardInterrupt:
+            print('\nStopped watching.')
+        finally:
+            watcher.close()
+
+    def close(self):
+        """Closes the connections and the response cache"""
+        self.client.close()
+        if self.cache is not None:
+            self.cache.close()
+
+def read_manifest(path):
+    """Reads a batch manifest, a configuration file with a section for each LaTeX project
+    and an optional "[Defaults]" section for all of them. Returns the name, root directory,
+    BibTeX files by bibliography and excluded directories of each project"""
+    manifest = configparser.ConfigParser()
+    if not manifest.read(path, encoding='utf-8'):
+        raise OSError(f'cannot read the batch manifest {path}')
+    shared = dict(manifest['Defaults']) if manifest.has_section('Defaults') else {}
+    projects = []
+    for name in manifest.sections():
+        if name == 'Defaults':
+            continue
+        # the root is relative to the manifest, the other files are relative to the root
+        root = os.path.join(os.path.dirname(os.path.abspath(path)),
+                            os.path.expanduser(manifest[name].get('root', name)))
+        options = dict(shared)
+        if 'config' in manifest[name]:
+            project_config = configparser.ConfigParser()
+            project_config.read(os.path.join(root, manifest[name]['config']), encoding='utf-8')
+            if project_config.has_section('Defaults'):
+                options.update(project_config['Defaults'])
+        options.update(manifest[name])
+        bibtex_files = {name_provider: os.path.join(root, options[option])
+                        for name_provider, option in PROVIDER_OPTIONS if option in options}
+        projects.append((name, root, bibtex_files, options.get('exclude', '').split()))
+    return projects
+
+class BibBatch():
+    """Keeps the BibTeX files of many LaTeX projects in sync in one run, fetching every
+    missing key once"""
+    def __init__(self, shared_session):
+        self.session = shared_session
+        self.projects = []
+
+    def add_project(self, name, directory, bibtex_files=None, exclude=()):
+        """Adds a project with a session of its own, which shares the providers' settings, the
+        response cache, the connections and the statistics of the batch. The BibTeX files
+        are given by bibliography name, the others keep their names in the directory"""
+        bibtex_files = bibtex_files or {}
+        providers = ProviderRegistry()
+        for provider in self.session.providers:
+            provider = copy.copy(provider)
+            provider.bibtex_file = bibtex_files.get(provider.name, os.path.join(directory, provider.bibtex_file))
+            providers.register(provider)
+        tex_files = TexFiles(directory, None, self.session.tex.exclude_directories | set(exclude),
+                             processes=self.session.tex.processes)
+        database = BibDatabase(self.session.database.index_path, self.session.database.writer_class)
+        project = BibSession(tex_files, providers, database, self.session.cache, self.session.client)
+        project.metrics = self.session.metrics
+        self.projects.append((name, project))
+        return project
+
+    def scan(self):
+        """Finds the citation keys of all the projects, scanning their changed .tex files
+        together in parallel processes, and updates the index of the LaTeX files of the
+        batch"""
+        index = self.session.tex.index
+        walked = [(name, project, project.tex.walk()) for name, project in self.projects]
+        scanned = iter(index.update([path for _, _, paths in walked for path in paths],
+                                    self.session.tex.processes))
+        for name, project, paths in walked:
+            keys = {}
+            for _ in paths:
+                keys.update(dict.fromkeys(next(scanned)))
+            print(f'{name}: {len(keys)} citation keys')
+            project.add_keys(keys)
+        index.save()
+
+    def collect_missing(self):
+        """Reads the BibTeX files of all the projects, and cites the keys that are missing in
+        any of them in the session of the batch"""
+        for name, project in self.projects:
+            print(f'\nProject {name}:')
+            project.read_existing_files([provider.bibtex_file for provider in project.providers])
+            for provider in project.providers:
+                self.session.keys.of(self.session.providers[provider.name]).update(
+                    key for key in project.keys.of(provider) if key not in project.database)
+
+    def write_fetched(self, provider, key, record):
+        """Adds the fetched record of a key to the BibTeX files of the projects that miss it"""
+        for name, project in self.projects:
+            project_provider = project.providers[provider.name]
+            if key in project.keys.of(project_provider) and key not in project.database:
+                print(f'{name}: ', end='')
+                project.write_fetched(project_provider, key, record)
+
+    def prepare(self):
+        """Scans all the projects and reads their BibTeX files, so that the fetch stage of the
+        session of the batch can be planned"""
+        print(f'\nReading the LaTeX documents of {len(self.projects)} projects:')
+        with self.session.metrics.phase('read_latex'):
+            self.scan()
+        with self.session.metrics.phase('read_all_existing_files'):
+            self.collect_missing()
+
+    def run(self, workers=8, host_workers=2, offline=False):
+        """Scans all the projects, fetches the keys that are missing in any of them once, and
+        writes the records to the BibTeX files of the projects. Returns the keys that could
+        not be fetched, with the reason"""
+        metrics = self.session.metrics
+        self.prepare()
+        for name, project in self.projects:
+            print(f'\nWriting the BibTeX files of {name}:')
+            project.report_missing()
+        try:
+            with metrics.phase('fetch_and_write'):
+                self.session.fetch_all(workers, host_workers, offline, write=self.write_fetched)
+        finally:
+            with metrics.phase('write'):
+                for name, project in self.projects:
+                    project.database.flush()
+        self.session.report_failed_keys()
+        return self.session.keys.failed
 
 if __name__ == '__main__':
-    try:
-        proxy = {'http': os.environ['http_proxy']}
-    except KeyError as e:
-        proxy = {}
-    handler = req.ProxyHandler(proxy)
-    opener = req.build_opener(handler)
-
     arg_parser = argparse.ArgumentParser(description='Create BibTeX input and output files.')
     arg_parser.add_argument('--config',                         help='Configuration file; file header always starts with "[Defaults]".')
     arg_parser.add_argument('--a',     default='arxiv.bib',     help='ArXiv BibTeX input and output file.')
@@ -480,15 +2388,36 @@ if __name__ == '__main__':
     arg_parser.add_argument('--j',     default='jstor.bib',     help='JSTOR BibTeX input and output file.')
     arg_parser.add_argument('--m',     default='microsoft.bib', help='Microsoft Research BibTeX input and output file.')
     arg_parser.add_argument('--s',     default='springer.bib',  help='SpringerLink BibTeX input and output file.')
+    arg_parser.add_argument('--merge',  default='',             help='Single BibTeX input and output file of all the bibliographies, sorted by key.')
+    arg_parser.add_argument('--workers',      default=8, type=int, help='Maximum number of concurrent downloads.')
+    arg_parser.add_argument('--host-workers', default=2, type=int, help='Maximum number of concurrent downloads per website.')
+    arg_parser.add_argument('--arxiv-batch', default=50, type=int, help='Number of arXiv records per request to the arXiv API; 1 reads the abstract pages instead.')
+    arg_parser.add_argument('--retries',    default=3, type=int, help='Number of times a failed download is retried.')
+    arg_parser.add_argument('--backoff',    default=1.0, type=float, help='Seconds to wait before the first retry; doubled for every further retry.')
+    arg_parser.add_argument('--rate',       default=4.0, type=float, help='Maximum number of requests per second to a website; 0 means unlimited.')
+    arg_parser.add_argument('--host-rate',  action='append', default=[], metavar='HOST=RATE', help='Maximum number of requests per second to the host (repeatable).')
+    arg_parser.add_argument('--breaker',    default=5, type=int, help='Number of failures in a row after which a website is no longer asked.')
+    arg_parser.add_argument('--cache',      default=CACHE_FILE,  help='Response cache file; an empty name disables the cache.')
+    arg_parser.add_argument('--cache-ttl',  default=30, type=float, help='Number of days before a cached response expires.')
+    arg_parser.add_argument('--cache-size', default=100, type=float, help='Maximum size of the response cache in MB.')
+    arg_parser.add_argument('--bib-index',  default=BIB_INDEX_FILE, help='Index file of the BibTeX entries; an empty name disables it.')
+    arg_parser.add_argument('--tex-index',  default=TEX_INDEX_FILE, help='Index file of the LaTeX citations; an empty name disables it.')
+    arg_parser.add_argument('--exclude',    action='append', default=[], help='Directory name that should not be searched for .tex files (repeatable).')
+    arg_parser.add_argument('--offline',    action='store_true', help='Only use cached responses, never download.')
+    arg_parser.add_argument('--strict',     action='store_true', help='Also exit with status 1 if some keys were not found.')
+    arg_parser.add_argument('--plugins',    action='store_true', help='Also use the bibliographies of the installed get_bibtex.providers plugins.')
+    arg_parser.add_argument('--batch',      default='', metavar='MANIFEST', help='Process all the LaTeX projects listed in the manifest file in one run.')
+    arg_parser.add_argument('--processes',  default=None, type=int, help='Number of processes that scan the .tex and BibTeX files; defaults to the number of CPUs.')
+    arg_parser.add_argument('--plan',       nargs='?', const='text', choices=('text', 'json'), help='Only print which keys would be downloaded, as text or JSON, without downloading anything.')
+    arg_parser.add_argument('--watch',      action='store_true', help='Keep running and fetch newly cited keys whenever .tex files change.')
+    arg_parser.add_argument('--debounce',   default=0.5, type=float, help='Seconds without further changes before a watch round starts.')
+    arg_parser.add_argument('--poll',       default=None, type=float, help='Poll for changes every POLL seconds instead of using inotify.')
+    arg_parser.add_argument('--stats',      action='store_true', help='Print the time spent in each phase and the statistics of the downloads.')
+    arg_parser.add_argument('--metrics',    default='', help='File to write the statistics to as JSON.')
+    arg_parser.add_argument('--profile',    default='', help='File to write cProfile statistics to.')
+    arg_parser.add_argument('--tracemalloc', action='store_true', help='Trace memory allocations and report the peak and the largest ones.')
     args = arg_parser.parse_args()
-
-    arxiv_bibtex_file = args.a
-    base_bibtex_file = args.b
-    cogprints_bibtex_file = args.c
-    dblp_bibtex_file = args.d
-    jstor_bibtex_file = args.j
-    microsoft_bibtex_file = args.m
-    springer_bibtex_file = args.s
+    builtin_files = {option: arg_parser.get_default(option) for _, option in PROVIDER_OPTIONS}
 
     if args.config:
         config = configparser.ConfigParser()
@@ -498,16 +2427,98 @@ if __name__ == '__main__':
         arg_parser.set_defaults(**defaults)
         args = arg_parser.parse_args()
 
-        arxiv_bibtex_file = args.a
-        base_bibtex_file = args.b
-        cogprints_bibtex_file = args.c
-        dblp_bibtex_file = args.d
-        jstor_bibtex_file = args.j
-        microsoft_bibtex_file = args.m
-        springer_bibtex_file = args.s
-
-    read_all_existing_files()
-    read_latex()
-    open_url()
+    if args.batch and args.watch:
+        arg_parser.error('--watch cannot be used with --batch')
+    if args.plan and args.watch:
+        arg_parser.error('--watch cannot be used with --plan')
+    if args.batch and not os.path.isfile(args.batch):
+        arg_parser.error(f'batch manifest {args.batch} not found')
 
+    registry = ProviderRegistry(default_providers())
+    try:
+        # the providers of the configuration file replace the plugins and the built-in ones
+        for plugin in (plugin_providers() if args.plugins else []) + (config_providers(config) if args.config else []):
+            registry.register(plugin)
+    except ValueError as error:
+        arg_parser.error(str(error))
+    # a file given on the command line or in [Defaults] also applies to a provider that replaces
+    # a built-in one, which otherwise keeps its own file
+    for name_provider, option in PROVIDER_OPTIONS:
+        if getattr(args, option) != builtin_files[option]:
+            registry[name_provider].bibtex_file = getattr(args, option)
+    if isinstance(registry['arXiv'], ArxivProvider):
+        registry['arXiv'].batch_size = args.arxiv_batch
+    for bibliography in registry:
+        bibliography.bibtex_file = args.merge or bibliography.bibtex_file
+        bibliography.breaker.threshold = args.breaker
+    http_client = HttpClient()
+    http_client.retries = args.retries
+    http_client.backoff = args.backoff
+    http_client.limiter.rate = args.rate
+    http_client.limiter.host_rates.update((host, float(rate)) for host, _, rate in
+                                          (host_rate.partition('=') for host_rate in args.host_rate))
+    response_cache = None
+    if args.cache:
+        response_cache = ResponseCache(args.cache, args.cache_ttl * 86400, args.cache_size * 2**20)
+    session = BibSession(TexFiles('./', args.tex_index, args.exclude, processes=args.processes), registry,
+                         BibDatabase(args.bib_index, SortedBibFile if args.merge else BibFile),
+                         response_cache, http_client)
+
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    runner = session
+    if args.batch:
+        runner = BibBatch(session)
+        for batch_project in read_manifest(args.batch):
+            # a merged file replaces the BibTeX files of the bibliographies in every project
+            runner.add_project(*batch_project[:2], {} if args.merge else batch_project[2], batch_project[3])
+    if args.plan:
+        # the JSON plan is the only output on stdout, so that it can be piped
+        with contextlib.redirect_stdout(sys.stderr if args.plan == 'json' else sys.stdout):
+            runner.prepare()
+        fetch_plan = session.plan(args.offline)
+        if args.plan == 'json':
+            json.dump(fetch_plan.as_dict(), sys.stdout, indent=2)
+            print()
+        else:
+            fetch_plan.report()
+    else:
+        runner.run(args.workers, args.host_workers, args.offline)
+    if args.watch:
+        session.watch(lambda: session.open_url(args.workers, args.host_workers, args.offline),
+                      args.debounce, args.poll)
+    session.close()
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f'\nProfile written to {args.profile}, read it with: python -m pstats {args.profile}')
+    metrics_dump = session.metrics.as_dict()
+    if args.tracemalloc:
+        metrics_dump['memory'] = dict(zip(('current', 'peak'), tracemalloc.get_traced_memory()))
+        print(f'\nMemory: {metrics_dump["memory"]["peak"] / 2**20:.1f} MB at the peak, largest allocations:')
+        for allocation in tracemalloc.take_snapshot().statistics('lineno')[:10]:
+            print(allocation)
+        tracemalloc.stop()
+    if args.stats:
+        session.metrics.report()
+    if args.metrics:
+        with open(args.metrics, 'w', encoding='utf-8') as metrics_file:
+            json.dump(metrics_dump, metrics_file, indent=2)
+
+    if args.plan:
+        sys.exit(0)
+    if session.keys.failed:
+        print('\nAll done, but some keys could not be fetched. :-(')
+        sys.exit(1)
+    if args.strict and session.keys.not_found:
+        print('\nAll done, but some keys were not found. :-(')
+        sys.exit(1)
     print('\nAll done. :-)')
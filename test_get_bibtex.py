@@ -0,0 +1,463 @@
+"""Tests of get_bibtex against a local HTTP server that stands in for the arXiv API, DBLP and
+BASE.
+
+Usage:
+  python -m unittest"""
+
+import contextlib
+import http.server
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import get_bibtex
+
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_fixtures')
+FEED = '<?xml version="1.0" encoding="UTF-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n{}</feed>\n'
+UNKNOWN_ID = '2101.99999'  # an identifier that the stand-in arXiv API has no entry for
+REJECTED_IDS = ('2101.99998', '2101.123', 'hep-th/99')  # identifiers that fail a whole request
+UNAVAILABLE_ID = 'conf/x/Down'  # a DBLP record that the stand-in is always too busy to send
+GONE_ID = 'conf/x/Gone'  # a DBLP record that the stand-in does not have
+
+def api_entry(ident):
+    """Returns the Atom entry of the arXiv API fixture for the identifier, which may have a
+    version"""
+    with open(os.path.join(FIXTURES_DIRECTORY, 'arxiv-api.xml'), encoding='utf-8') as fixture:
+        entry = fixture.read().replace('{id}v1', '{id}')
+    return entry.replace('{id}', ident if re.search(r'v\d+$', ident) else f'{ident}v1')
+
+def field_names(record):
+    """Returns the names of the fields of a BibTeX record dumped by BibItem in order"""
+    return re.findall(r'^([a-z-]+)=\{', record, re.MULTILINE)
+
+class StandInArxivProvider(get_bibtex.ArxivProvider):
+    """An ArxivProvider that asks the stand-in server instead of the arXiv API"""
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the arXiv API with an entry for each requested identifier that it knows, DBLP
+    with a BibTeX record, and BASE with an HTML page instead of a record"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Sends the response to the request and keeps the requested identifiers"""
+        parts = urlsplit(self.path)
+        if parts.path == '/api/query':
+            ids = parse_qs(parts.query)['id_list'][0].split(',')
+            self.server.batches.append(ids)
+            if any(ident in REJECTED_IDS for ident in ids):
+                self.send_error(400, 'incorrect id format')
+                return
+            body = FEED.format(''.join(api_entry(ident) for ident in ids if ident != UNKNOWN_ID))
+        elif parts.path.startswith('/base/'):
+            self.server.batches.append([parts.path])
+            body = '<html><body>Please prove that you are not a robot.</body></html>\n'
+        elif parts.path == f'/dblp/{UNAVAILABLE_ID}':
+            self.send_error(503, 'service unavailable')
+            return
+        elif parts.path == f'/dblp/{GONE_ID}':
+            self.send_error(404, 'not found')
+            return
+        else:
+            ident = unquote(parts.path[len('/dblp/'):])
+            body = f'@article{{DBLP:{ident},\n  title = {{{ident}}}\n}}\n'
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Keeps the requests out of the output"""
+
+class StandInTest(unittest.TestCase):
+    """Runs sessions in a temporary directory against the stand-in server"""
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        cls.server.daemon_threads = True
+        cls.server.batches = []
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+        StandInArxivProvider.API_URL = cls.base_url + '/api/query?id_list={ids}&max_results={count}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='get_bibtex_test_')
+        self.server.batches.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_session(self, batch_size=50, cache=None):
+        """Returns a session of the temporary directory that downloads from the stand-in
+        server"""
+        arxiv = StandInArxivProvider(os.path.join(self.directory, 'arxiv.bib'), batch_size)
+        dblp = get_bibtex.TemplateProvider('DBLP', {'prefix': 'DBLP:', 'url': self.base_url + '/dblp/{id}',
+                                                    'bibtex_file': os.path.join(self.directory, 'dblp.bib'),
+                                                    'writer': 'entries'})
+        base = get_bibtex.TemplateProvider('BASE', {'prefix': 'BASE:', 'url': self.base_url + '/base/{id}',
+                                                    'bibtex_file': os.path.join(self.directory, 'base.bib')})
+        client = get_bibtex.HttpClient(proxies={})
+        client.limiter = get_bibtex.RateLimiter(0)
+        client.backoff = 0
+        return get_bibtex.BibSession(get_bibtex.TexFiles(self.directory),
+                                     get_bibtex.ProviderRegistry([arxiv, dblp, base]),
+                                     get_bibtex.BibDatabase(''), cache, client)
+
+    def cite(self, keys):
+        """Writes a .tex file citing the keys"""
+        with open(os.path.join(self.directory, 'paper.tex'), 'w', encoding='utf-8') as tex_file:
+            tex_file.write(f'\\cite{{{", ".join(keys)}}}\n')
+
+    def run_session(self, cache=None, offline=False):
+        """Runs a session of the temporary directory without printing anything, and returns
+        it"""
+        session = self.make_session(cache=cache)
+        with contextlib.redirect_stdout(io.StringIO()):
+            session.run(workers=4, host_workers=2, offline=offline)
+        session.close()
+        return session
+
+    def plan(self, cache=None, offline=False):
+        """Returns the fetch plan of a new session of the temporary directory"""
+        session = self.make_session(cache=cache)
+        with contextlib.redirect_stdout(io.StringIO()):
+            session.prepare()
+        return session.plan(offline)
+
+class ArxivBatchTest(StandInTest):
+    """Requests arXiv records in batches from the stand-in arXiv API and splits the responses
+    into the records of the cited keys"""
+    def test_batch_requests(self):
+        """The keys are sorted and grouped into requests of at most batch_size identifiers"""
+        provider = self.make_session(batch_size=50).providers['arXiv']
+        keys = [f'Arxiv:2101.{number:05d}' for number in range(120, 0, -1)]
+        requests = get_bibtex.batch_requests(provider, keys)
+        self.assertEqual([len(request_keys) for _, request_keys, _ in requests], [50, 50, 20])
+        self.assertEqual([key for _, request_keys, _ in requests for key in request_keys], sorted(keys))
+        self.assertTrue(requests[2][2].endswith('id_list=2101.00101,2101.00102,2101.00103,2101.00104,'
+                                                '2101.00105,2101.00106,2101.00107,2101.00108,2101.00109,'
+                                                '2101.00110,2101.00111,2101.00112,2101.00113,2101.00114,'
+                                                '2101.00115,2101.00116,2101.00117,2101.00118,2101.00119,'
+                                                '2101.00120&max_results=20'))
+
+    def test_malformed_ids_alone(self):
+        """The keys that are not well-formed arXiv identifiers are requested one by one"""
+        provider = self.make_session(batch_size=50).providers['arXiv']
+        keys = ['Arxiv:2101.00001', 'Arxiv:2101.123', 'Arxiv:2101.00002v2', 'Arxiv:hep-th/99',
+                'Arxiv:hep-th/9901001', 'Arxiv:math.GT/0309136', 'Arxiv:0704.0001']
+        requests = get_bibtex.batch_requests(provider, keys)
+        self.assertEqual([request_keys for _, request_keys, _ in requests],
+                         [('Arxiv:2101.123',), ('Arxiv:hep-th/99',),
+                          ('Arxiv:0704.0001', 'Arxiv:2101.00001', 'Arxiv:2101.00002v2',
+                           'Arxiv:hep-th/9901001', 'Arxiv:math.GT/0309136')])
+
+    def test_split(self):
+        """The entries of an API response are matched to the cited keys with or without a
+        version and with old-style identifiers, and are written under the cited keys"""
+        provider = self.make_session().providers['arXiv']
+        keys = ['Arxiv:2101.00001', 'Arxiv:2101.00002v2', 'Arxiv:hep-th/9901001', f'Arxiv:{UNKNOWN_ID}']
+        content = FEED.format(''.join(api_entry(ident) for ident in ('hep-th/9901001', '2101.00002v2', '2101.00001')))
+        records = provider.split(keys, content)
+        self.assertEqual(sorted(records), sorted(keys[:3]))
+        for key, record in records.items():
+            self.assertTrue(record.startswith(f'@article{{{key},\n'))
+        self.assertIn('eprint={arXiv:hep-th/9901001}', records['Arxiv:hep-th/9901001'])
+        self.assertIn('url={http://arxiv.org/abs/2101.00002}', records['Arxiv:2101.00002v2'])
+
+    def test_api_fields_match_abstract_page(self):
+        """The records of the API have the fields of the abstract pages in the same order,
+        and the comments that the page parser leaves out"""
+        with open(os.path.join(FIXTURES_DIRECTORY, 'arxiv.html'), encoding='utf-8') as fixture:
+            page = fixture.read().replace('{id}', '2201.01234').replace('{authors}', 'Ada Lovelace')
+        page_parser = get_bibtex.ArxivPageParser(get_bibtex.ArxivProvider(batch_size=1), ['Arxiv:2201.01234'])
+        page_parser.feed(page.replace('{abstract}', 'An abstract.').encode('utf-8'))
+        page_record = page_parser.close()['Arxiv:2201.01234']
+        api_record = get_bibtex.ArxivProvider().split(['Arxiv:2201.01234'],
+                                                      FEED.format(api_entry('2201.01234')))['Arxiv:2201.01234']
+        self.assertEqual([name for name in field_names(api_record) if name != 'comments'],
+                         field_names(page_record))
+        self.assertIn('subjects={cs.DL; cs.IR}', api_record)
+
+    def test_fetch_in_batches(self):
+        """A run requests the arXiv records in batches, writes them under the cited keys, and
+        a second run has nothing left to request but the unknown key"""
+        keys = [f'Arxiv:2101.{number:05d}' for number in range(1, 111)] + [
+            'Arxiv:hep-th/9901001', 'Arxiv:2102.00001v3', f'Arxiv:{UNKNOWN_ID}', 'DBLP:conf/x/A']
+        self.cite(keys)
+        session = self.run_session()
+        self.assertEqual(sorted(len(batch) for batch in self.server.batches), [13, 50, 50])
+        self.assertEqual(session.keys.failed, {})
+        with open(os.path.join(self.directory, 'arxiv.bib'), encoding='utf-8') as bibtex_file:
+            written = re.findall(r'^@article\{([^,]+),', bibtex_file.read(), re.MULTILINE)
+        self.assertEqual(written, sorted(key for key in keys if key.startswith('Arxiv:') and UNKNOWN_ID not in key))
+
+        self.server.batches.clear()
+        plan = self.plan()
+        self.assertEqual(plan.steps['arXiv']['fetch'], [f'Arxiv:{UNKNOWN_ID}'])
+        self.assertEqual(plan.steps['DBLP']['fetch'], [])
+        self.assertEqual(plan.requests(), 1)
+
+    def test_rejected_batch_split(self):
+        """A batch that the API rejects is asked for again in halves, so that only the keys
+        that the API rejects on their own fail"""
+        keys = [f'Arxiv:2101.{number:05d}' for number in range(1, 21)] + [f'Arxiv:{ident}' for ident in REJECTED_IDS]
+        self.cite(keys)
+        session = self.run_session()
+        self.assertEqual(sorted(session.keys.failed), sorted(f'Arxiv:{ident}' for ident in REJECTED_IDS))
+        with open(os.path.join(self.directory, 'arxiv.bib'), encoding='utf-8') as bibtex_file:
+            written = re.findall(r'^@article\{([^,]+),', bibtex_file.read(), re.MULTILINE)
+        self.assertEqual(written, keys[:20])
+        self.assertIn(['2101.123'], self.server.batches)
+        self.assertIn(['2101.99998'], self.server.batches)
+        self.assertEqual(session.metrics.providers['arXiv']['split_requests'], 4)
+
+class ResponseCacheTest(StandInTest):
+    """Caches the downloaded records in the response cache"""
+    def test_error_page_not_cached(self):
+        """A page without a BibTeX entry fails its key and is not cached, so that the next run
+        asks for it again, while the records are cached"""
+        self.cite(['BASE:robot', 'DBLP:conf/x/A'])
+        cache = get_bibtex.ResponseCache(os.path.join(self.directory, 'cache.sqlite'))
+        session = self.run_session(cache)
+        self.assertEqual(list(session.keys.failed), ['BASE:robot'])
+        os.remove(os.path.join(self.directory, 'dblp.bib'))
+        plan = self.plan(cache)
+        self.assertEqual(plan.steps['BASE']['cached'], [])
+        self.assertEqual(plan.steps['BASE']['fetch'], ['BASE:robot'])
+        self.assertEqual(plan.steps['DBLP']['cached'], ['DBLP:conf/x/A'])
+        self.server.batches.clear()
+        self.assertEqual(list(self.run_session(cache).keys.failed), ['BASE:robot'])
+        self.assertEqual(self.server.batches, [['/base/robot']])
+
+    def test_expired_and_offline(self):
+        """An expired record is downloaded again, unless we are offline, when it is used
+        anyway and only the keys that were never cached are unavailable"""
+        keys = ['Arxiv:2101.00001', 'Arxiv:2101.00002', 'DBLP:conf/x/A']
+        self.cite(keys)
+        path = os.path.join(self.directory, 'cache.sqlite')
+        self.run_session(get_bibtex.ResponseCache(path))
+        for name in ('arxiv.bib', 'dblp.bib'):
+            os.remove(os.path.join(self.directory, name))
+        self.cite(keys + ['DBLP:conf/x/B'])
+        plan = self.plan(get_bibtex.ResponseCache(path))
+        self.assertEqual(plan.steps['arXiv']['cached'], keys[:2])
+        self.assertEqual(plan.steps['DBLP']['fetch'], ['DBLP:conf/x/B'])
+        self.assertEqual(plan.requests(), 1)
+
+        expired = get_bibtex.ResponseCache(path, ttl=-1)
+        plan = self.plan(expired)
+        self.assertEqual(plan.steps['arXiv']['fetch'], keys[:2])
+        self.assertEqual(plan.steps['DBLP']['fetch'], ['DBLP:conf/x/A', 'DBLP:conf/x/B'])
+        self.assertEqual(plan.requests(), 3)
+        plan = self.plan(expired, offline=True)
+        self.assertEqual(plan.steps['DBLP']['cached'], ['DBLP:conf/x/A'])
+        self.assertEqual(plan.steps['DBLP']['unavailable'], ['DBLP:conf/x/B'])
+        self.assertEqual(plan.requests(), 0)
+
+        self.server.batches.clear()
+        self.run_session(expired, offline=True)
+        self.assertEqual(self.server.batches, [])
+        with open(os.path.join(self.directory, 'dblp.bib'), encoding='utf-8') as bibtex_file:
+            self.assertEqual(re.findall(r'^@article\{([^,]+),', bibtex_file.read(), re.MULTILINE), ['DBLP:conf/x/A'])
+        plan = self.plan(expired, offline=True)
+        self.assertEqual(plan.steps['arXiv']['present'], keys[:2])
+        self.assertEqual(plan.steps['DBLP']['present'], ['DBLP:conf/x/A'])
+
+    def test_least_recently_used_evicted(self):
+        """A cache that outgrows its size limit evicts the least recently used responses"""
+        cache = get_bibtex.ResponseCache(os.path.join(self.directory, 'cache.sqlite'), max_size=350)
+        for key in ('a', 'b', 'c'):
+            cache.put_many('DBLP', {key: key * 100})
+        self.assertEqual(cache.get('DBLP', 'a'), 'a' * 100)
+        cache.put_many('DBLP', {'d': 'd' * 100})
+        self.assertEqual(cache.cached_keys('DBLP', 'abcd'), {'a', 'c', 'd'})
+        self.assertEqual(cache.total_size(), 300)
+        cache.close()
+
+class MetricsTest(StandInTest):
+    """Counts the requests of each bibliography and times the phases of a run"""
+    def test_every_attempt_counted(self):
+        """A request that is retried counts once for every time it was sent, and the writer
+        stage is timed within the fetch"""
+        self.cite([f'DBLP:{UNAVAILABLE_ID}', 'DBLP:conf/x/A'])
+        session = self.run_session()
+        self.assertEqual(list(session.keys.failed), [f'DBLP:{UNAVAILABLE_ID}'])
+        counters = session.metrics.providers['DBLP']
+        self.assertEqual(counters['requests'], 1 + session.client.retries + 1)
+        self.assertEqual(counters['retries'], session.client.retries)
+        self.assertIn('fetch_and_write.writer', session.metrics.phases)
+
+class NotFoundTest(StandInTest):
+    """Reports the keys that the websites have no record of"""
+    def test_not_found_listed(self):
+        """A key that is missing in a batch response or answered with 404 is not found rather
+        than failed, and is listed at the end of the run"""
+        self.cite([f'Arxiv:{UNKNOWN_ID}', f'DBLP:{GONE_ID}', 'DBLP:conf/x/A'])
+        session = self.make_session()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            session.run(workers=4, host_workers=2)
+        session.close()
+        self.assertEqual(session.keys.failed, {})
+        self.assertEqual(session.keys.not_found, {f'Arxiv:{UNKNOWN_ID}', f'DBLP:{GONE_ID}'})
+        self.assertIn(f'The following keys were not found:\nArxiv:{UNKNOWN_ID}\nDBLP:{GONE_ID}\n',
+                      output.getvalue())
+
+class BibFileTest(unittest.TestCase):
+    """Writes the new entries behind the existing ones of a BibTeX file"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='get_bibtex_test_')
+        self.path = os.path.join(self.directory, 'references.bib')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failed_flush_keeps_file(self):
+        """A flush that fails leaves the BibTeX file as it was and no temporary file behind,
+        and a flush keeps the permissions of the BibTeX file"""
+        with open(self.path, 'w', encoding='utf-8') as bibtex_file:
+            bibtex_file.write('@article{beta,\n  title = {B}\n}\n')
+        os.chmod(self.path, 0o600)
+        writer = get_bibtex.BibFile(self.path)
+        writer.add('alpha', '@article{alpha,\n  title = {A}\n}\n')
+        writer.pending.append(('gamma', None))
+        with self.assertRaises(TypeError):
+            writer.flush()
+        self.assertEqual(os.listdir(self.directory), ['references.bib'])
+        with open(self.path, encoding='utf-8') as bibtex_file:
+            self.assertEqual(bibtex_file.read(), '@article{beta,\n  title = {B}\n}\n')
+        writer.pending.pop()
+        writer.flush()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        self.assertEqual(os.listdir(self.directory), ['references.bib'])
+
+class SortedBibFileTest(unittest.TestCase):
+    """Writes a merged BibTeX file sorted by key"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='get_bibtex_test_')
+        self.path = os.path.join(self.directory, 'references.bib')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_strings_stay_in_front(self):
+        """The @string, @preamble and @comment blocks keep their order in front of the sorted
+        entries, so that a string is defined before the entry that uses it"""
+        with open(self.path, 'w', encoding='utf-8') as bibtex_file:
+            bibtex_file.write('% references\n\n@string{jacm = "J. ACM"}\n\n@article{beta,\n  journal = jacm\n}\n\n'
+                              '@preamble{"\\newcommand{\\noop}[1]{}"}\n@comment{jabref-meta: x}\n'
+                              '@article{alpha,\n  title = {A}\n}\n')
+        writer = get_bibtex.SortedBibFile(self.path)
+        writer.add('gamma', '@article{gamma,\n  journal = jacm\n}\n')
+        offsets = writer.flush()
+        with open(self.path, 'rb') as bibtex_file:
+            written = bibtex_file.read()
+        self.assertEqual(written.decode('utf-8'),
+                         '% references\n\n@string{jacm = "J. ACM"}\n\n@preamble{"\\newcommand{\\noop}[1]{}"}\n\n'
+                         '@comment{jabref-meta: x}\n\n@article{alpha,\n  title = {A}\n}\n\n'
+                         '@article{beta,\n  journal = jacm\n}\n\n@article{gamma,\n  journal = jacm\n}\n\n')
+        self.assertEqual(sorted(offsets), ['alpha', 'beta', 'gamma'])
+        for key, (offset, length) in offsets.items():
+            self.assertTrue(written[offset:offset + length].startswith(f'@article{{{key},'.encode('utf-8')))
+
+    def test_cross_referenced_last(self):
+        """The entries that other entries refer to with crossref come after all of the
+        others, and an existing entry wins over a new one with the same key"""
+        with open(self.path, 'w', encoding='utf-8') as bibtex_file:
+            bibtex_file.write('@proceedings{conf,\n  title = {C}\n}\n@inproceedings{zeta,\n  crossref = {conf}\n}\n'
+                              '@article{alpha,\n  title = {old}\n}\n')
+        writer = get_bibtex.SortedBibFile(self.path)
+        writer.add('beta', '@inproceedings{beta,\n  crossref = {conf}\n}\n')
+        writer.add('alpha', '@article{alpha,\n  title = {new}\n}\n')
+        writer.add('aaa', '@proceedings{aaa,\n  title = {A}\n}\n')
+        writer.flush()
+        with open(self.path, encoding='utf-8') as bibtex_file:
+            written = bibtex_file.read()
+        self.assertEqual(re.findall(r'^@[a-z]+\{([^,]+),', written, re.MULTILINE), ['aaa', 'alpha', 'beta', 'zeta', 'conf'])
+        self.assertIn('title = {old}', written)
+        self.assertNotIn('title = {new}', written)
+
+class BibDatabaseTest(unittest.TestCase):
+    """Indexes the BibTeX files in a snapshot file"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='get_bibtex_test_')
+        self.index_path = os.path.join(self.directory, 'bibtex.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_bibtex_file(self, name, keys):
+        """Writes a BibTeX file with an entry for each of the keys, and returns its path"""
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as bibtex_file:
+            bibtex_file.writelines(f'@article{{{key},\n  title = {{{key}}}\n}}\n' for key in keys)
+        return path
+
+    def test_snapshot_size_stays_the_same(self):
+        """Saving the snapshot again while one file is unchanged and another one is rewritten
+        keeps its size, and the entries of both are still found"""
+        large = self.write_bibtex_file('large.bib', [f'Large:{number:05d}' for number in range(2000)])
+        sizes = []
+        for round_number in range(4):
+            small = self.write_bibtex_file('small.bib', [f'Small:{number:03d}r{round_number % 2}'
+                                                         for number in range(100)])
+            database = get_bibtex.BibDatabase(self.index_path)
+            database.read_all([large, small])
+            database.flush()
+            database.snapshot.close()
+            sizes.append(os.path.getsize(self.index_path))
+        self.assertEqual(len(set(sizes)), 1)
+        database = get_bibtex.BibDatabase(self.index_path)
+        database.read_all([large, small])
+        self.assertEqual(database.unchanged, [os.path.abspath(large), os.path.abspath(small)])
+        self.assertEqual(database.entry('Large:01234'), '@article{Large:01234,\n  title = {Large:01234}\n}\n')
+        self.assertIn('Small:099r1', database)
+        self.assertNotIn('Small:099r0', database)
+        self.assertEqual(len(list(database)), 2100)
+        database.snapshot.close()
+
+    def test_snapshot_reused(self):
+        """An unchanged BibTeX file is looked up in the snapshot without being parsed, also
+        after new entries have been added to it, while a changed one is parsed again"""
+        path = self.write_bibtex_file('references.bib', ['alpha', 'beta'])
+        database = get_bibtex.BibDatabase(self.index_path)
+        database.read_all([path])
+        self.assertEqual(list(database.files), [os.path.abspath(path)])
+        database.flush()
+        database.snapshot.close()
+
+        database = get_bibtex.BibDatabase(self.index_path)
+        database.read_all([path])
+        self.assertEqual((database.files, database.unchanged), ({}, [os.path.abspath(path)]))
+        self.assertTrue(database.add(path, 'gamma', '@article{gamma,\n  title = {gamma}\n}\n'))
+        self.assertFalse(database.add(path, 'beta', '@article{beta,\n  title = {again}\n}\n'))
+        database.flush()
+        database.snapshot.close()
+
+        database = get_bibtex.BibDatabase(self.index_path)
+        database.read_all([path])
+        self.assertEqual(database.files, {})
+        self.assertEqual(list(database), ['alpha', 'beta', 'gamma'])
+        self.assertEqual(database.entry('gamma'), '@article{gamma,\n  title = {gamma}\n}\n')
+        database.snapshot.close()
+
+        with open(path, 'a', encoding='utf-8') as bibtex_file:
+            bibtex_file.write('@article{delta,\n  title = {delta}\n}\n')
+        database = get_bibtex.BibDatabase(self.index_path)
+        database.read_all([path])
+        self.assertEqual((list(database.files), database.unchanged), ([os.path.abspath(path)], []))
+        self.assertEqual(database.entry('delta'), '@article{delta,\n  title = {delta}\n}\n')
+        database.snapshot.close()
+
+if __name__ == '__main__':
+    unittest.main()